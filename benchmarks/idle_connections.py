@@ -0,0 +1,117 @@
+"""
+Measure the resident memory held per idle agent connection.
+
+Every count runs in a fresh interpreter, opens that many AgentServers on
+fake websockets, has them join a few spaces, starts their receive and
+send loops with a broker that never delivers anything and reports how
+much the resident set grew per connection::
+
+    python benchmarks/idle_connections.py
+    python benchmarks/idle_connections.py --counts 1000 10000 --spaces 3
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import subprocess
+import sys
+from types import SimpleNamespace
+
+
+def resident_bytes():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+class Space(object):
+    def __init__(self, uuid, name):
+        self.uuid = uuid
+        self.name = name
+
+
+class IdleWebSocket(object):
+    def __init__(self, forever):
+        self.forever = forever
+
+    async def receive(self):
+        await self.forever.wait()
+
+    async def send(self, message):
+        pass
+
+
+class IdlePubSub(object):
+    def __init__(self, forever):
+        self.forever = forever
+
+    async def subscribe(self, *channels):
+        pass
+
+    async def unsubscribe(self, *channels):
+        pass
+
+    async def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        await self.forever.wait()
+
+
+async def open_connections(count, space_count):
+    from zentropi import Frame
+    from zentropi import Kind
+
+    from zencelium.agent_server import AgentServer
+
+    forever = asyncio.Event()
+    space_names = [f'space-{i}' for i in range(space_count)]
+    gc.collect()
+    before = resident_bytes()
+    agent_servers = []
+    for i in range(count):
+        agent_server = AgentServer(IdleWebSocket(forever))
+        agent_server.connected = True
+        agent_server.pubsub = IdlePubSub(forever)
+        agent_server.agent = SimpleNamespace(uuid=f'agent-{i}', name=f'agent-{i}')
+        agent_server.subscribed = True
+        # every agent loads its own copies of the spaces, as join does from the database
+        await agent_server.join([Space(name, name) for name in space_names])
+        await agent_server.websocket_send(Frame('login-ok', kind=Kind.COMMAND))
+        agent_server.receive_loops = (
+            asyncio.ensure_future(agent_server.websocket_recv()),
+            asyncio.ensure_future(agent_server.broadcast_recv()),
+            asyncio.ensure_future(agent_server.websocket_send_loop()),
+        )
+        agent_servers.append(agent_server)
+    await asyncio.sleep(0.5)  # let every loop settle into its idle wait
+    gc.collect()
+    after = resident_bytes()
+    for agent_server in agent_servers:
+        await agent_server.stop()
+    return after - before
+
+
+def measure(count, space_count):
+    return asyncio.run(open_connections(count, space_count))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--counts', nargs='+', default=[1000, 10000, 100000], type=int)
+    parser.add_argument('--spaces', default=2, type=int, help='spaces joined by every agent')
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps({'bytes': measure(args.child, args.spaces)}))
+        return
+
+    print(f'{"connections":>12} {"resident MB":>12} {"bytes each":>11}')
+    for count in args.counts:
+        result = subprocess.run(
+            [sys.executable, __file__, '--child', str(count), '--spaces', str(args.spaces)],
+            stdout=subprocess.PIPE, universal_newlines=True, check=True)
+        grown = json.loads(result.stdout.splitlines()[-1])['bytes']
+        print(f'{count:12d} {grown / 2 ** 20:12.1f} {grown / count:11.0f}')
+
+
+if __name__ == '__main__':
+    main()
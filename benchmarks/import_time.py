@@ -0,0 +1,64 @@
+"""
+Measure how long it takes to start the zencelium command line app.
+
+Runs ``python -X importtime`` on a module in a fresh interpreter, prints the
+slowest imports by cumulative time and exits with status 1 when the total is
+above the budget, so it can run in CI to catch startup regressions::
+
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --module zencelium.web --top 30
+"""
+import argparse
+import subprocess
+import sys
+from time import perf_counter
+
+
+def import_times(module):
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line.split(':', 1)[1].split('|')
+        times.append((int(cumulative_us), int(self_us), name.rstrip()))
+    return times
+
+
+def wall_time(args, repeat):
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        subprocess.run(args, stdout=subprocess.DEVNULL, check=True)
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--module', default='zencelium.cli')
+    parser.add_argument('--top', default=15, type=int)
+    parser.add_argument('--repeat', default=5, type=int)
+    parser.add_argument('--budget-ms', default=150.0, type=float,
+                        help='fail when the cumulative import time is above this')
+    args = parser.parse_args()
+
+    times = import_times(args.module)
+    total_ms = max(cumulative for cumulative, _, _ in times) / 1000
+    print(f'{"cumulative ms":>14} {"self ms":>9}  module')
+    for cumulative, self_us, name in sorted(times, reverse=True)[:args.top]:
+        print(f'{cumulative / 1000:14.1f} {self_us / 1000:9.1f}  {name.strip()}')
+
+    help_s = wall_time(
+        [sys.executable, '-c', 'from zencelium.cli import cli; cli(["--help"])'], args.repeat)
+    print(f'\nimport {args.module}: {total_ms:.1f} ms (budget {args.budget_ms:.0f} ms)')
+    print(f'zencelium --help: {help_s * 1000:.1f} ms wall time (best of {args.repeat})')
+    if total_ms > args.budget_ms:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
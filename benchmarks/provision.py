@@ -0,0 +1,60 @@
+"""
+Time a bulk import into a fresh SQLite database.
+
+Generates accounts, spaces, agents and memberships adding up to ``--rows``
+records, imports them with ``zencelium.provision.import_records`` and exits
+with status 1 when the import takes longer than the budget::
+
+    python benchmarks/provision.py --rows 100000 --budget 10
+"""
+import argparse
+import sys
+from bcrypt import gensalt
+from bcrypt import hashpw
+from tempfile import TemporaryDirectory
+from pathlib import Path
+from time import perf_counter
+
+from zencelium.models import Account
+from zencelium.models import db_init
+from zencelium.provision import import_records
+
+
+def generate_records(rows, accounts=10, spaces_per_account=100):
+    password_hash = hashpw(Account._encode_password('bench'), gensalt()).decode('utf-8')
+    records = []
+    for a in range(accounts):
+        records.append({'type': 'account', 'name': f'account-{a}', 'password_hash': password_hash})
+        for s in range(spaces_per_account):
+            records.append({'type': 'space', 'account': f'account-{a}', 'name': f'space-{s}'})
+    agents = (rows - len(records)) // 2
+    for i in range(agents):
+        account, space = f'account-{i % accounts}', f'space-{i % spaces_per_account}'
+        records.append({'type': 'agent', 'account': account, 'name': f'agent-{i}'})
+        records.append({'type': 'membership', 'account': account, 'agent': f'agent-{i}', 'space': space})
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--rows', default=100000, type=int)
+    parser.add_argument('--budget', default=10.0, type=float, help='seconds')
+    args = parser.parse_args()
+
+    records = generate_records(args.rows)
+    with TemporaryDirectory() as directory:
+        db = db_init(str(Path(directory).joinpath('bench.db')))
+        start = perf_counter()
+        result = import_records(records)
+        elapsed = perf_counter() - start
+        db.close()
+
+    print(f'Imported {len(records)} records in {elapsed:.2f}s '
+          f'({len(records) / elapsed:.0f} records/s, budget {args.budget:.0f}s)')
+    print(f'Created {result["created"]}, {len(result["tokens"])} tokens')
+    if elapsed > args.budget:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+"""
+Compare frame throughput and latency across event loops and server settings.
+
+Starts ``zencelium run`` once per combination of ``--loops`` and
+``--workers`` against a fresh SQLite database and a running Redis, keeps
+``--connections`` http keep-alive connections posting frames to
+``/api/frame/`` for ``--duration`` seconds and reports requests per second
+and latency percentiles::
+
+    python benchmarks/server_tuning.py
+    python benchmarks/server_tuning.py --loops asyncio uvloop --workers 1 4 \\
+        --set server_backlog=1024 --set websocket_ping_interval=20
+
+``--set`` takes any ``zencelium.ini`` field and applies it to every run.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+from configparser import ConfigParser
+from itertools import product
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import monotonic
+from time import sleep
+from uuid import uuid4
+
+START_TIMEOUT = 20.0  # seconds
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def provision(database):
+    from zencelium.models import db_init
+    from zencelium.provision import import_records
+
+    db = db_init(database)
+    result = import_records([
+        {'type': 'account', 'name': 'bench', 'password': uuid4().hex},
+        {'type': 'space', 'account': 'bench', 'name': 'bench'},
+        {'type': 'agent', 'account': 'bench', 'name': 'bench'},
+        {'type': 'membership', 'account': 'bench', 'agent': 'bench', 'space': 'bench'},
+    ])
+    db.close()
+    return result['tokens'][0]['token']
+
+
+def write_config(directory, settings):
+    # the server reads zencelium.ini from XDG_CONFIG_HOME, see web.CONFIG_PATH
+    env = dict(os.environ, XDG_CONFIG_HOME=str(directory.joinpath('config')))
+    script = 'from zencelium.web import CONFIG_PATH; print(CONFIG_PATH)'
+    config_path = Path(subprocess.run(
+        [sys.executable, '-c', script], env=env, stdout=subprocess.PIPE,
+        universal_newlines=True, check=True).stdout.strip())
+    parser = ConfigParser()
+    parser['zencelium'] = dict(settings, log_file_path=str(directory.joinpath('zencelium.log')))
+    config_path.parent.mkdir(parents=True, exist_ok=True)
+    with config_path.open('w') as config_file:
+        parser.write(config_file)
+    return env
+
+
+def wait_for_port(port, process):
+    deadline = monotonic() + START_TIMEOUT
+    while monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'zencelium run exited with {process.returncode}')
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            sleep(0.1)
+    raise RuntimeError(f'zencelium run did not listen on {port} within {START_TIMEOUT:.0f}s')
+
+
+async def post_frames(port, token, deadline, latencies):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    errors = 0
+    try:
+        while monotonic() < deadline:
+            body = json.dumps({'kind': 2, 'name': 'bench', 'uuid': uuid4().hex, 'data': {'value': 1}}).encode()
+            writer.write(
+                b'POST /api/frame/ HTTP/1.1\r\nHost: bench\r\nContent-Type: application/json\r\n'
+                b'Authorization: Bearer ' + token.encode() + b'\r\n'
+                b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+            start = monotonic()
+            status = await reader.readuntil(b'\r\n')
+            headers = await reader.readuntil(b'\r\n\r\n')
+            length = 0
+            for line in headers.split(b'\r\n'):
+                name, _, value = line.partition(b':')
+                if name.strip().lower() == b'content-length':
+                    length = int(value)
+            await reader.readexactly(length)
+            latencies.append(monotonic() - start)
+            if b' 200 ' not in status:
+                errors += 1
+    finally:
+        writer.close()
+    return errors
+
+
+async def load(port, token, connections, duration):
+    latencies = []
+    deadline = monotonic() + duration
+    start = monotonic()
+    errors = await asyncio.gather(*(post_frames(port, token, deadline, latencies) for _ in range(connections)))
+    return latencies, sum(errors), monotonic() - start
+
+
+def run_variant(env, port, token, loop, workers, args):
+    command = [
+        sys.executable, '-c', 'from zencelium.cli import cli; cli()', 'run', '--port', str(port),
+        '--loop', loop, '--workers', str(workers)]
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port, process)
+        latencies, errors, elapsed = asyncio.run(load(port, token, args.connections, args.duration))
+    finally:
+        process.terminate()
+        process.wait()
+    return {
+        'loop': loop,
+        'workers': workers,
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / elapsed,
+        'p50': percentile(latencies, 0.5) * 1000,
+        'p99': percentile(latencies, 0.99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--loops', nargs='+', default=['asyncio', 'uvloop'], choices=['asyncio', 'uvloop'])
+    parser.add_argument('--workers', nargs='+', default=[1, 2], type=int)
+    parser.add_argument('--connections', default=50, type=int)
+    parser.add_argument('--duration', default=10.0, type=float, help='seconds per run')
+    parser.add_argument('--port', default=26599, type=int)
+    parser.add_argument('--broker-url', default='redis://localhost')
+    parser.add_argument('--set', dest='settings', action='append', default=[], metavar='NAME=VALUE')
+    parser.add_argument('--json', action='store_true', help='print one json object per run')
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as directory:
+        directory = Path(directory)
+        database = str(directory.joinpath('bench.db'))
+        settings = {
+            'database_url': database,
+            'broker_urls': args.broker_url,
+            'template_cache_path': '',
+            'loop_block_threshold': '0',
+        }
+        settings.update(setting.split('=', 1) for setting in args.settings)
+        env = write_config(directory, settings)
+        token = provision(database)
+        if not args.json:
+            print(f'{"loop":>8} {"workers":>8} {"requests":>9} {"errors":>7} {"req/s":>9} {"p50 ms":>8} {"p99 ms":>8}')
+        for loop, workers in product(args.loops, args.workers):
+            try:
+                result = run_variant(env, args.port, token, loop, workers, args)
+            except RuntimeError as e:
+                print(f'{loop:>8} {workers:8d} skipped: {e}', file=sys.stderr)
+                continue
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print(f'{loop:>8} {workers:8d} {result["requests"]:9d} {result["errors"]:7d} '
+                      f'{result["rps"]:9.0f} {result["p50"]:8.2f} {result["p99"]:8.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -78,6 +78,9 @@ setup(
         # eg: 'aspectlib==1.1.1', 'six>=1.7',
     ],
     extras_require={
+        "postgres": ["psycopg2-binary"],
+        "brotli": ["brotli"],
+        "uvloop": ["uvloop"],
         # eg:
         #   'rst': ['docutils>=0.11'],
         #   ':python_version=="2.6"': ['argparse'],
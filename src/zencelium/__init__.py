@@ -1,6 +1,8 @@
+import atexit
 import logging
 import logging.handlers
 from pathlib import Path
+from queue import SimpleQueue
 from os import makedirs as make_directories
 
 __version__ = '2020.0.1'
@@ -8,6 +10,7 @@ __app_name__ = 'zencelium'
 
 _root_logger = logging.getLogger(__name__)
 _root_logger_configured = False
+_log_listener = None
 
 BYTE = 1
 KB = 1024 * BYTE
@@ -15,11 +18,18 @@ MB = 1024 * KB
 GB = 1024 * MB
 
 
+class _LocalQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # the queue never leaves this process, leave formatting to the listener thread
+        return record
+
+
 def configure_logging(file_path,
                       log_level=logging.WARNING,
                       file_size= 10 * MB,
                       keep_logs=10):
     global _root_logger_configured
+    global _log_listener
     assert _root_logger_configured is False, 'root_logger is already configured!'
 
     file_formatter = logging.Formatter(
@@ -37,8 +47,14 @@ def configure_logging(file_path,
     ch.setFormatter(console_formatter)
     ch.setLevel(log_level)
 
-    _root_logger.addHandler(fh)
-    _root_logger.addHandler(ch)
+    # file writes and rotation happen on the listener thread, not the event loop
+    log_queue = SimpleQueue()
+    _log_listener = logging.handlers.QueueListener(
+        log_queue, fh, ch, respect_handler_level=True)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+
+    _root_logger.addHandler(_LocalQueueHandler(log_queue))
     _root_logger.setLevel(logging.DEBUG)
 
     _root_logger_configured = True
@@ -1,9 +1,12 @@
 import asyncio
+import heapq
 import logging
+from itertools import count as counter
+from time import monotonic
+from time import time
 from uuid import uuid4
 from typing import Iterable
 
-from redis.asyncio import Redis
 from asgiref.sync import async_to_sync
 from quart import session
 
@@ -11,14 +14,57 @@ from zentropi import KB
 from zentropi import Frame
 from zentropi import Kind
 
+from .aggregate import KINDS as AGGREGATE_KINDS
+from .aggregate import aggregate_hub
+from .capture import traffic_capture
+from .ingress import BUFFER_MAX_SIZE
+from .ingress import FRAME_MAX_SIZE
+from .ingress import FrameError
+from .ingress import parse_frames
 from .models import Agent
 from .models import Space
 from .models import Account
+from .name_filter import shared_filter
 from .space_server import space_server
+from .timers import timer_wheel
+from .util import RateLimitedLog
 from .util import add_space_to_meta
+from .util import frame_deadline
+from .util import frame_expired
+from .util import target_agent_name
 from .util import timestamp
 
 logger = logging.getLogger(__name__)
+hot_path_logger = RateLimitedLog(logger)
+
+BATCH_WINDOW = 0.005  # seconds to wait for more frames before sending a batch
+BATCH_WINDOW_MAX = 1.0
+BATCH_SIZE = 16 * KB  # send the batch early once it grows past this many bytes
+BATCH_SIZE_MAX = 256 * KB
+
+# Outbound frames wait in one lane per priority, lower lanes are sent first.
+LANE_COMMAND = 0
+LANE_REQUEST = 1  # requests and responses
+LANE_BULK = 2  # messages and events
+LANE_SIZE = 1024  # bulk frames queued before the relay waits for the websocket
+
+# Websocket protocol pings keep proxies and NAT mappings open, but the server
+# never checks for their pongs, so they do not notice a dead peer. Instead a
+# new login for the same agent replaces a connection that has been silent for
+# TAKEOVER_IDLE, and an agent that answers "ping" commands may ask for them
+# at login to have its connection reaped when it stops answering.
+TAKEOVER_IDLE = 30.0  # seconds of silence before a new login may replace the connection
+KEEPALIVE_INTERVAL_MIN = 5.0  # seconds of silence before the agent is pinged
+KEEPALIVE_INTERVAL_MAX = 3600.0
+KEEPALIVE_TIMEOUT = 15.0  # seconds to answer a ping before the connection is reaped
+
+
+def frame_lane(kind) -> int:
+    if kind == Kind.COMMAND:
+        return LANE_COMMAND
+    if kind == Kind.REQUEST or kind == Kind.RESPONSE:
+        return LANE_REQUEST
+    return LANE_BULK
 
 
 def on_event(_name):
@@ -61,68 +107,219 @@ def on_response(_name):
     return wrap
 
 
+_outbound_seq = counter()  # keeps frames of one lane in the order they were queued
+NO_SPACES = frozenset()
+
+
 class AgentServer(object):
+    # A node holds one of these per websocket, mostly idle, so instances keep
+    # only per-connection state in slots. Handler tables are built once per
+    # class, and filters and spaces are shared and replaced instead of mutated.
+    __slots__ = (
+        "websocket",
+        "account",
+        "agent",
+        "spaces",
+        "pubsub",
+        "connected",
+        "receive_loops",
+        "subscribed",
+        "frames_expired",
+        "_filter_event_names",
+        "_filter_message_names",
+        "_filter_request_names",
+        "_frame_max_size",
+        "_batch_window",
+        "_batch_size",
+        "_outbound",
+        "_bulk_queued",
+        "_outbound_ready",
+        "_lane_space",
+        "_send_lock",
+        "last_activity",
+        "keepalive_interval",
+        "_keepalive",
+        "connected_at",
+        "frames_in",
+        "bytes_in",
+        "frames_out",
+        "bytes_out",
+    )
+    ingress_max_size = FRAME_MAX_SIZE
+    ingress_buffer_size = BUFFER_MAX_SIZE
+    keepalive_timeout = KEEPALIVE_TIMEOUT
+    takeover_idle = TAKEOVER_IDLE
+    space_server = space_server
+    _handlers_command = {}
+    _handlers_event = {}
+    _handlers_message = {}
+    _handlers_request = {}
+    _handlers_response = {}
+
     def __init__(self, websocket):
         self.websocket = websocket
         self.account = None  # set by login()
         self.agent = None  # set by login()
-        self.spaces = set()  # set by login(), join() and leave()
-        self.redis = None
+        self.spaces = NO_SPACES  # set by login(), join() and leave()
         self.pubsub = None
         self.connected = False
-        self.receive_loops = tuple()  # set by start()
-        self._handlers_command = {}
-        self._handlers_event = {}
-        self._handlers_message = {}
-        self._handlers_request = {}
-        self._handlers_response = {}
-        self.space_server = space_server
-        self._filter_event_names = {"*"}
-        self._filter_message_names = {"*"}
-        self._filter_request_names = {"*"}
-        self.load_handlers()
-        self._frame_max_size = 2 * KB
+        self.receive_loops = ()  # set by start()
         self.subscribed = False
-
-    def load_handlers(self):
-        for attr_name in dir(self):
-            attr = getattr(self, attr_name)
+        self.frames_expired = 0
+        self._filter_event_names = shared_filter(["*"])
+        self._filter_message_names = shared_filter(["*"])
+        self._filter_request_names = shared_filter(["*"])
+        self._frame_max_size = 2 * KB
+        self._batch_window = 0  # set by filter or login, zero disables batching
+        self._batch_size = BATCH_SIZE
+        self._outbound = []  # heap of (lane, seq, deadline, frame_as_json)
+        self._bulk_queued = 0
+        self._outbound_ready = asyncio.Event()
+        self._lane_space = None  # created when a sender first waits for the bulk lane
+        self._send_lock = asyncio.Lock()
+        self.last_activity = 0.0  # monotonic time the agent last sent anything
+        self.keepalive_interval = 0.0  # set by login, zero sends no ping commands
+        self._keepalive = None  # timer handle of the next keepalive check
+        self.connected_at = 0.0  # set by start()
+        self.frames_in = 0
+        self.bytes_in = 0
+        self.frames_out = 0
+        self.bytes_out = 0
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.load_handlers()
+
+    @classmethod
+    def load_handlers(cls):
+        cls._handlers_command = {}
+        cls._handlers_event = {}
+        cls._handlers_message = {}
+        cls._handlers_request = {}
+        cls._handlers_response = {}
+        for attr_name in dir(cls):
+            attr = getattr(cls, attr_name)
             if not callable(attr):
                 continue
             if getattr(attr, "handle_event", None):
-                self._handlers_event[getattr(attr, "handle_event")] = attr
+                cls._handlers_event[getattr(attr, "handle_event")] = attr
             elif getattr(attr, "handle_command", None):
-                self._handlers_command[getattr(attr, "handle_command")] = attr
+                cls._handlers_command[getattr(attr, "handle_command")] = attr
             elif getattr(attr, "handle_message", None):
-                self._handlers_message[getattr(attr, "handle_message")] = attr
+                cls._handlers_message[getattr(attr, "handle_message")] = attr
             elif getattr(attr, "handle_request", None):
-                self._handlers_request[getattr(attr, "handle_request")] = attr
+                cls._handlers_request[getattr(attr, "handle_request")] = attr
             elif getattr(attr, "handle_response", None):
-                self._handlers_response[getattr(attr, "handle_response")] = attr
+                cls._handlers_response[getattr(attr, "handle_response")] = attr
 
     async def start(self):
         self.connected = True
-        self.redis = Redis.from_url("redis://localhost")
-        self.pubsub = self.redis.pubsub()
+        self.pubsub = self.space_server.brokers.pubsub()
+        self.last_activity = monotonic()
+        self.connected_at = time()
         try:
             await self._session_login()
             ws_recv_loop = asyncio.create_task(self.websocket_recv())
             bc_recv_loop = asyncio.create_task(self.broadcast_recv())
-            self.receive_loops = (ws_recv_loop, bc_recv_loop)
+            ws_send_loop = asyncio.create_task(self.websocket_send_loop())
+            self.receive_loops = (ws_recv_loop, bc_recv_loop, ws_send_loop)
             await asyncio.gather(*self.receive_loops)
         except Exception as e:
             await self.stop()
             raise e
         finally:
+            self.connected = False
+            if self._keepalive:
+                self._keepalive.cancel()
+            await aggregate_hub.unsubscribe(self)
             if self.agent:
-                await space_server.agent_server_remove(self.agent)
-            await self.redis.close()
+                await space_server.agent_server_remove(self.agent, self)
+            await self.pubsub.close()
 
     async def stop(self):
         for task in self.receive_loops:
             task.cancel()
 
+    def idle_time(self) -> float:
+        return monotonic() - self.last_activity
+
+    def replaceable(self) -> bool:
+        """Whether a new login for the agent may take over, see TAKEOVER_IDLE."""
+        idle = self.idle_time()
+        if self.keepalive_interval and idle >= self.keepalive_interval:
+            return True  # it was pinged and has not answered yet
+        return idle >= self.takeover_idle
+
+    def describe(self) -> dict:
+        # built from memory only, it runs for every connection of an admin request
+        now = time()
+        return {
+            "agent": self.agent.name if self.agent else None,
+            "account": self.account.name if self.account else None,
+            "spaces": sorted(space.name for space in self.spaces),
+            "filters": {
+                "event": sorted(self._filter_event_names.patterns),
+                "message": sorted(self._filter_message_names.patterns),
+                "request": sorted(self._filter_request_names.patterns),
+            },
+            "frame_max_size": self._frame_max_size,
+            "batch_window": self._batch_window,
+            "connected_at": self.connected_at,
+            "connected_for": now - self.connected_at,
+            "frames_in": self.frames_in,
+            "bytes_in": self.bytes_in,
+            "frames_out": self.frames_out,
+            "bytes_out": self.bytes_out,
+            "frames_expired": self.frames_expired,
+            "queue_depth": len(self._outbound),
+            "last_activity": now - self.idle_time(),
+            "idle_for": self.idle_time(),
+            "keepalive_interval": self.keepalive_interval,
+        }
+
+    def _configure_keepalive(self, interval):
+        if self._keepalive:
+            self._keepalive.cancel()
+            self._keepalive = None
+        try:
+            interval = float(interval or 0)
+        except (TypeError, ValueError):
+            interval = 0.0
+        if interval <= 0:
+            self.keepalive_interval = 0.0
+            return
+        self.keepalive_interval = min(max(interval, KEEPALIVE_INTERVAL_MIN), KEEPALIVE_INTERVAL_MAX)
+        self._keepalive = timer_wheel.schedule(self.keepalive_interval, self._keepalive_check)
+
+    def _keepalive_check(self):
+        if not self.connected:
+            return
+        idle = self.idle_time()
+        if idle >= self.keepalive_interval + self.keepalive_timeout:
+            logger.info("Reap agent %s, silent for %.0f seconds", self.agent, idle)
+            asyncio.ensure_future(self.stop())
+            return
+        if idle >= self.keepalive_interval:
+            self._queue(Frame("ping", kind=Kind.COMMAND))
+            next_check = self.keepalive_interval + self.keepalive_timeout - idle
+        else:
+            next_check = self.keepalive_interval - idle
+        self._keepalive = timer_wheel.schedule(next_check, self._keepalive_check)
+
+    async def drain(self, reconnect_delay: float):
+        frame = Frame(
+            "reconnect", kind=Kind.COMMAND, data={"delay": round(reconnect_delay, 3)}
+        )
+        add_space_to_meta(frame, "server", "server")
+        try:
+            await self.websocket_send(frame)
+            await self.websocket_flush()
+        finally:
+            await self.stop()
+
     async def frame_handler(self, frame) -> None:
+        if traffic_capture.enabled:
+            traffic_capture.ingress(self.account, self.agent, self.spaces, frame)
         kind = frame.kind
         name = frame.name
         if kind == Kind.COMMAND:
@@ -162,15 +359,119 @@ class AgentServer(object):
                 return
         else:
             raise KeyError(f"Unknown kind {kind} in {name}")
-        await handler(frame)
+        await handler(self, frame)
 
     async def websocket_recv(self):
         while self.connected:
-            frame = Frame.from_json(await self.websocket.receive())
-            await self.frame_handler(frame)
+            message = await self.websocket.receive()
+            self.last_activity = monotonic()
+            self.bytes_in += len(message)
+            try:
+                frames = parse_frames(
+                    message, self.ingress_max_size, self.ingress_buffer_size
+                )
+            except FrameError as e:
+                hot_path_logger.info(
+                    "reject", "Reject frame from agent %s: %s", self.agent, e
+                )
+                reply = Frame("frame-invalid", kind=Kind.COMMAND, data={"reason": str(e)})
+                await self.websocket_send(reply)
+                continue
+            self.frames_in += len(frames)
+            # batched frames are handled in the order they were sent
+            for frame in frames:
+                await self.frame_handler(frame)
 
-    async def websocket_send(self, frame: Frame):
-        await self.websocket.send(frame.to_json())
+    async def websocket_send(self, frame: Frame, frame_as_json: str = None):
+        if frame_as_json is None:
+            frame_as_json = frame.to_json()
+        lane = frame_lane(frame.kind)
+        if lane == LANE_BULK:
+            # only bulk frames wait, replies to commands must never block
+            while self._bulk_queued >= LANE_SIZE:
+                if self._lane_space is None:
+                    self._lane_space = asyncio.Event()
+                self._lane_space.clear()
+                await self._lane_space.wait()
+            self._bulk_queued += 1
+        self._queue(frame, frame_as_json, lane)
+
+    def _queue(self, frame: Frame, frame_as_json: str = None, lane: int = None):
+        if frame_as_json is None:
+            frame_as_json = frame.to_json()
+        if lane is None:
+            lane = frame_lane(frame.kind)
+        heapq.heappush(
+            self._outbound,
+            (lane, next(_outbound_seq), frame_deadline(frame), frame_as_json),
+        )
+        self._outbound_ready.set()
+
+    def _take_outbound(self):
+        if self._batch_window:
+            max_frames, max_bytes = None, self._batch_size
+        else:
+            max_frames, max_bytes = 1, None
+        outbound = self._outbound
+        messages = []
+        size = 0
+        now = time()
+        if self._lane_space is not None:
+            self._lane_space.set()
+        while outbound and len(messages) != max_frames:
+            lane, _, deadline, frame_as_json = outbound[0]
+            if messages and max_bytes and size + len(frame_as_json) > max_bytes:
+                break
+            heapq.heappop(outbound)
+            if lane == LANE_BULK:
+                self._bulk_queued -= 1
+            if deadline is not None and deadline < now:
+                self.frames_expired += 1
+                continue
+            messages.append(frame_as_json)
+            size += len(frame_as_json)
+        return messages
+
+    async def _send_messages(self, messages):
+        if self._batch_window:
+            message = "[" + ",".join(messages) + "]"
+        else:
+            message = messages[0]
+        self.frames_out += len(messages)
+        self.bytes_out += len(message)
+        await self.websocket.send(message)
+
+    async def websocket_send_loop(self):
+        while True:
+            await self._outbound_ready.wait()
+            if self._batch_window:
+                await asyncio.sleep(self._batch_window)  # let the batch fill up
+            async with self._send_lock:
+                messages = self._take_outbound()
+                if not messages:
+                    self._outbound_ready.clear()
+                    continue
+                await self._send_messages(messages)
+
+    async def websocket_flush(self):
+        async with self._send_lock:
+            while True:
+                messages = self._take_outbound()
+                if not messages:
+                    return
+                await self._send_messages(messages)
+
+    async def _configure_batch(self, options):
+        if not options:
+            await self.websocket_flush()
+            self._batch_window = 0
+            return
+        if not isinstance(options, dict):
+            options = {}
+        window = float(options.get("window", BATCH_WINDOW * 1000)) / 1000
+        size = int(options.get("size", BATCH_SIZE))
+        self._batch_window = min(max(window, 0.001), BATCH_WINDOW_MAX)
+        self._batch_size = min(max(size, 1), BATCH_SIZE_MAX)
 
     async def broadcast_recv(self):
         while True:
@@ -194,40 +495,40 @@ class AgentServer(object):
                 frame._uuid = ""
                 frame._meta = {}
                 frame_as_json = frame.to_json()
-                logger.warning(
-                    f"Strip uuid and meta from frame as agent {self.agent.name} requested small frames."
+                hot_path_logger.warning(
+                    "strip",
+                    "Strip uuid and meta from frame as agent %s requested small frames.",
+                    self.agent.name,
                 )
 
             if len(frame_as_json) > self._frame_max_size:
-                logger.warning(
-                    f"Skip frame: {frame.name} for agent {self.agent.name} as size ({len(frame_as_json)}) is larger than {self._frame_max_size} bytes."
+                hot_path_logger.warning(
+                    "oversize",
+                    "Skip frame: %s for agent %s as size (%d) is larger than %d bytes.",
+                    frame.name,
+                    self.agent.name,
+                    len(frame_as_json),
+                    self._frame_max_size,
                 )
                 continue
 
             if frame.kind == Kind.EVENT:
-                if "*" in self._filter_event_names:
-                    await self.websocket_send(frame)
-                    continue
-                elif frame.name in self._filter_event_names:
-                    await self.websocket_send(frame)
+                if frame.name in self._filter_event_names:
+                    await self.websocket_send(frame, frame_as_json)
                     continue
             elif frame.kind == Kind.MESSAGE:
-                if "*" in self._filter_message_names:
-                    await self.websocket_send(frame)
-                    continue
-                elif frame.name in self._filter_message_names:
-                    await self.websocket_send(frame)
+                if frame.name in self._filter_message_names:
+                    await self.websocket_send(frame, frame_as_json)
                     continue
             elif frame.kind == Kind.REQUEST or frame.kind == Kind.RESPONSE:
-                if "*" in self._filter_request_names:
-                    await self.websocket_send(frame)
-                    continue
-                elif frame.name in self._filter_request_names:
-                    await self.websocket_send(frame)
+                if frame.name in self._filter_request_names:
+                    await self.websocket_send(frame, frame_as_json)
                     continue
-            logger.info(f"Skipping frame: {frame.name} for agent {self.agent.name}")
+            hot_path_logger.info(
+                "skip", "Skipping frame: %s for agent %s", frame.name, self.agent.name
+            )
 
-    async def broadcast_send(self, frame: Frame, spaces: Iterable[Space]):
+    def _add_source_meta(self, frame: Frame):
         meta = {
             "source": {
                 "name": self.agent.name,
@@ -238,15 +539,54 @@ class AgentServer(object):
         # ensure outgoig requests get responses
         if frame.kind == Kind.REQUEST:
             if frame.name not in self._filter_request_names:
-                self._filter_request_names.add(frame.name)
+                # filters are shared between agents, copy before adding
+                self._filter_request_names = shared_filter(
+                    self._filter_request_names.patterns | {frame.name}
+                )
         if frame.meta:
             frame._meta.update(meta)
         else:
             frame._meta = meta
+
+    async def broadcast_send(self, frame: Frame, spaces: Iterable[Space]):
+        self._add_source_meta(frame)
         if not spaces:
-            logger.warning(f"No spaces for broadcast for agent {self.agent.name}")
+            hot_path_logger.warning(
+                "no-spaces", "No spaces for broadcast for agent %s", self.agent.name
+            )
         await self.space_server.broadcast(frame, spaces=spaces)
 
+    async def unicast_send(self, frame: Frame, agent_name: str):
+        self._add_source_meta(frame)
+        if not await self.space_server.unicast(frame, self.account, agent_name):
+            reply = Frame(
+                "target-unknown", kind=Kind.COMMAND, data={"agent": agent_name}
+            )
+            await self.websocket_send(reply)
+
+    async def relay(self, frame: Frame):
+        if frame_expired(frame):
+            self.frames_expired += 1
+            return
+        if await self.space_server.is_duplicate(frame, self.agent):
+            hot_path_logger.debug(
+                "duplicate", "Drop duplicate frame %s from agent %s", frame.uuid, self.agent.name
+            )
+            return
+        try:
+            target = target_agent_name(frame)
+            if target:
+                await self.unicast_send(frame, target)
+                return
+            spaces = self.spaces
+            if frame.meta and frame.meta.get("spaces"):
+                space_names = self._clean_space_names(frame.meta)
+                spaces = self._get_spaces_from_names(space_names)
+            await self.broadcast_send(frame, spaces=spaces)
+        except Exception:
+            await self.space_server.forget_frame(frame, self.agent)
+            raise
+
     async def _session_login(self):
         logged_in = session.get("logged_in")
         account_name = session.get("account_name")
@@ -274,9 +614,9 @@ class AgentServer(object):
         if not spaces:
             logger.debug(f"No spaces to join for agent {self.agent}")
             return
+        spaces = [self.space_server.intern_space(space) for space in spaces]
         channels = [space.uuid for space in spaces]
-        for space in spaces:
-            self.spaces.add(space)
+        self.spaces = self.spaces.union(spaces)
         if channels:
             await self.pubsub.subscribe(*channels)
             self.subscribed = True
@@ -285,9 +625,9 @@ class AgentServer(object):
         if not spaces:
             logger.debug(f"No spaces to leave for agent {self.agent}")
             return
+        spaces = list(spaces)
         channels = [space.uuid for space in spaces]
-        for space in spaces:
-            self.spaces.remove(space)
+        self.spaces = self.spaces.difference(spaces)
         if channels:
             await self.pubsub.unsubscribe(*channels)
             if not self.spaces and not self.agent:
@@ -300,12 +640,18 @@ class AgentServer(object):
         if not token or not agent:
             await self.websocket_send(frame.reply("login-failed"))
             logger.info(f"Login failed for {frame.data}")
+            await self.websocket_flush()
             await self.stop()
             return
         self.account = agent.account
         reply = frame.reply("login-ok")
         add_space_to_meta(reply, "server", "server")
         await self.websocket_send(reply)
+        if "batch" in frame.data:
+            await self._configure_batch(frame.data["batch"])
+        if "keepalive" in frame.data:
+            # opt in to ping commands, for agents that answer them with pong
+            self._configure_keepalive(frame.data["keepalive"])
         logger.info(f"Logged in agent {agent.name} for account {self.account.name}")
 
     def _clean_space_names(self, obj: dict):
@@ -353,11 +699,81 @@ class AgentServer(object):
             self._frame_max_size = int(frame.data.get("size"))
 
         if frame.data.get("names"):
-            self._filter_event_names = set(frame.data["names"].get("event", []))
-            self._filter_message_names = set(frame.data["names"].get("message", []))
-            self._filter_request_names = set(frame.data["names"].get("request", []))
+            names = frame.data["names"]
+            self._filter_event_names = shared_filter(names.get("event", []))
+            self._filter_message_names = shared_filter(names.get("message", []))
+            self._filter_request_names = shared_filter(names.get("request", []))
 
         await self.websocket_send(frame.reply("filter-ok"))
+        if "batch" in frame.data:
+            await self._configure_batch(frame.data["batch"])
+
+    @on_command("aggregate")
+    async def cmd_aggregate(self, frame: Frame):
+        space_names = self._clean_space_names(frame.data)
+        if space_names:
+            spaces = self._get_spaces_from_names(space_names)
+        else:
+            spaces = self.spaces
+        spaces = list(spaces)
+        if not spaces:
+            await self.websocket_send(
+                frame.reply("aggregate-failed", data={"reason": "No spaces to aggregate."})
+            )
+            return
+        subscriptions = []
+        try:
+            kind = AGGREGATE_KINDS[frame.data.get("kind", "event")]
+            for space in spaces:
+                subscriptions.append(await aggregate_hub.subscribe(
+                    self,
+                    space,
+                    name=frame.data.get("name"),
+                    field=frame.data.get("field"),
+                    aggregate=frame.data.get("aggregate", "mean"),
+                    seconds=frame.data.get("window", 1),
+                    kind=kind,
+                    output_name=frame.data.get("as"),
+                ))
+        except Exception as e:
+            # all or nothing, the agent gets no ids it could cancel
+            for subscription in subscriptions:
+                await aggregate_hub.unsubscribe(self, subscription.id)
+            if isinstance(e, (KeyError, TypeError, ValueError)):
+                reason = str(e)
+            else:
+                logger.exception("Unable to subscribe agent %s to aggregates", self.agent)
+                reason = "Unable to subscribe."
+            await self.websocket_send(
+                frame.reply("aggregate-failed", data={"reason": reason})
+            )
+            return
+        await self.websocket_send(
+            frame.reply(
+                "aggregate-ok", data={"ids": [subscription.id for subscription in subscriptions]}
+            )
+        )
+
+    @on_command("aggregate-cancel")
+    async def cmd_aggregate_cancel(self, frame: Frame):
+        ids = frame.data.get("ids")
+        if ids is None:
+            removed = await aggregate_hub.unsubscribe(self)
+        else:
+            removed = 0
+            for subscription_id in ids:
+                removed += await aggregate_hub.unsubscribe(self, int(subscription_id))
+        await self.websocket_send(
+            frame.reply("aggregate-cancel-ok", data={"removed": removed})
+        )
+
+    @on_command("ping")
+    async def cmd_ping(self, frame: Frame):
+        await self.websocket_send(frame.reply("pong"))
+
+    @on_command("pong")
+    async def cmd_pong(self, frame: Frame):
+        pass  # receiving it already counted as activity
 
     @on_command("*")
     async def cmd_unknown(self, frame: Frame):
@@ -367,32 +783,19 @@ class AgentServer(object):
 
     @on_event("*")
     async def evt_relay(self, frame: Frame):
-        spaces = self.spaces
-        if frame.meta and frame.meta.get("spaces"):
-            space_names = self._clean_space_names(frame.meta)
-            spaces = self._get_spaces_from_names(space_names)
-        await self.broadcast_send(frame, spaces=spaces)
+        await self.relay(frame)
 
     @on_message("*")
     async def msg_relay(self, frame: Frame):
-        spaces = self.spaces
-        if frame.meta and frame.meta.get("spaces"):
-            space_names = self._clean_space_names(frame.meta)
-            spaces = self._get_spaces_from_names(space_names)
-        await self.broadcast_send(frame, spaces=spaces)
+        await self.relay(frame)
 
     @on_request("*")
     async def req_relay(self, frame: Frame):
-        spaces = self.spaces
-        if frame.meta and frame.meta.get("spaces"):
-            space_names = self._clean_space_names(frame.meta)
-            spaces = self._get_spaces_from_names(space_names)
-        await self.broadcast_send(frame, spaces=spaces)
+        await self.relay(frame)
 
     @on_response("*")
     async def resp_relay(self, frame: Frame):
-        spaces = self.spaces
-        if frame.meta and frame.meta.get("spaces"):
-            space_names = self._clean_space_names(frame.meta)
-            spaces = self._get_spaces_from_names(space_names)
-        await self.broadcast_send(frame, spaces=spaces)
+        await self.relay(frame)
+
+
+AgentServer.load_handlers()
@@ -0,0 +1,228 @@
+"""
+Windowed aggregates of numeric frame data, computed on the server.
+
+An agent that only needs, say, the mean temperature per second subscribes
+with the ``aggregate`` command instead of receiving every raw event::
+
+    {"kind": 1, "name": "aggregate", "data": {
+        "name": "sensor.temperature", "field": "celsius", "aggregate": "mean",
+        "window": 1, "spaces": ["kitchen"]}}
+
+Raw frames are read once per process from the space channels and folded
+into a running count, sum, min, max and last value per space and window.
+When a window closes, every subscriber gets one summary event per space,
+windows without any matching frame are skipped.
+"""
+import asyncio
+import json
+import logging
+from itertools import count as counter
+from time import time
+from typing import Optional
+
+from zentropi import Frame
+from zentropi import Kind
+
+from .name_filter import NameFilter
+from .util import add_space_to_meta
+from .util import timestamp
+
+logger = logging.getLogger(__name__)
+
+AGGREGATES = ('count', 'min', 'max', 'mean', 'last')
+KINDS = {'event': Kind.EVENT, 'message': Kind.MESSAGE}
+WINDOW_MIN = 0.1  # seconds
+WINDOW_MAX = 3600.0
+READ_RETRY_DELAY = 1.0  # seconds to wait after the broker failed before reading again
+
+
+def field_value(data, field: str):
+    """Return the number at the dotted ``field`` path of ``data``, or None."""
+    for key in field.split('.'):
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key)
+    if isinstance(data, bool) or not isinstance(data, (int, float)):
+        return None
+    return data
+
+
+class AggregateSubscription(object):
+    def __init__(self, subscription_id: int, agent_server, aggregate: str, output_name: str):
+        self.id = subscription_id
+        self.agent_server = agent_server
+        self.aggregate = aggregate
+        self.output_name = output_name
+
+
+class Window(object):
+    """Running aggregates of one field of matching frames in one space."""
+
+    def __init__(self, channel: str, space_name: str, name: str, kind: int, field: str, seconds: float):
+        self.channel = channel
+        self.space_name = space_name
+        self.name = name
+        self.names = NameFilter([name])
+        self.kind = kind
+        self.field = field
+        self.seconds = seconds
+        self.subscribers = {}  # subscription id -> AggregateSubscription
+        self.task = None
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.last = None
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.last = value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def value(self, aggregate: str):
+        if aggregate == 'count':
+            return self.count
+        if aggregate == 'mean':
+            return self.total / self.count if self.count else None
+        return getattr(self, aggregate)
+
+
+class AggregateHub(object):
+    """Share windowed aggregates between all agents of this process.
+
+    Windows with the same space, name, kind, field and length are computed
+    once, whatever aggregates their subscribers asked for. Windows are
+    aligned to multiples of their length, so summaries for the same window
+    from different workers cover the same time span.
+    """
+
+    def __init__(self):
+        self.windows = {}  # (channel, name, kind, field, seconds) -> Window
+        self.channels = {}  # channel -> set of Window
+        self.pubsub = None
+        self._reader = None
+        self._ids = counter(1)
+
+    async def init(self, brokers):
+        self.pubsub = brokers.pubsub()
+
+    async def subscribe(self, agent_server, space, name: str, field: str, aggregate: str,
+                        seconds: float, kind: int = Kind.EVENT, output_name: Optional[str] = None):
+        if aggregate not in AGGREGATES:
+            raise ValueError(f'Expected aggregate to be one of {", ".join(AGGREGATES)}, got {aggregate!r}.')
+        if not name or not field:
+            raise ValueError('Expected a frame name and a data field to aggregate.')
+        seconds = min(max(float(seconds), WINDOW_MIN), WINDOW_MAX)
+        key = (space.uuid, name, kind, field, seconds)
+        if space.uuid not in self.channels:
+            # subscribe before anything is registered, so a broker error leaves no trace
+            await self.pubsub.subscribe(space.uuid)
+            self.channels.setdefault(space.uuid, set())
+        window = self.windows.get(key)
+        if window is None:
+            window = self.windows[key] = Window(space.uuid, space.name, name, kind, field, seconds)
+            self.channels[space.uuid].add(window)
+            window.task = asyncio.ensure_future(self._tick(window))
+        subscription = AggregateSubscription(
+            next(self._ids), agent_server, aggregate, output_name or f'{name}.{aggregate}')
+        window.subscribers[subscription.id] = subscription
+        if self._reader is None:
+            self._reader = asyncio.ensure_future(self._read())
+            self._reader.add_done_callback(self._reader_done)
+        return subscription
+
+    async def unsubscribe(self, agent_server, subscription_id: Optional[int] = None) -> int:
+        """Drop one subscription of ``agent_server``, or all of them."""
+        removed = 0
+        for key, window in list(self.windows.items()):
+            for subscription in list(window.subscribers.values()):
+                if subscription.agent_server is not agent_server:
+                    continue
+                if subscription_id is not None and subscription.id != subscription_id:
+                    continue
+                del window.subscribers[subscription.id]
+                removed += 1
+            if not window.subscribers:
+                await self._remove(key, window)
+        return removed
+
+    async def _remove(self, key, window):
+        del self.windows[key]
+        window.task.cancel()
+        windows = self.channels[window.channel]
+        windows.discard(window)
+        if not windows:
+            del self.channels[window.channel]
+            await self.pubsub.unsubscribe(window.channel)
+
+    async def _tick(self, window: Window):
+        while True:
+            now = time()
+            await asyncio.sleep(window.seconds - now % window.seconds)
+            if not window.count:
+                continue
+            end = time()
+            summary = {
+                'name': window.name,
+                'field': window.field,
+                'window': window.seconds,
+                'count': window.count,
+                'end': end,
+            }
+            values = {aggregate: window.value(aggregate) for aggregate in AGGREGATES}
+            window.reset()
+            sends = []
+            for subscription in list(window.subscribers.values()):
+                data = dict(summary, aggregate=subscription.aggregate, value=values[subscription.aggregate])
+                frame = Frame(subscription.output_name, kind=Kind.EVENT, data=data)
+                add_space_to_meta(frame, window.space_name, window.channel)
+                frame._meta['timestamp'] = timestamp()
+                sends.append(subscription.agent_server.websocket_send(frame))
+            # a slow agent must not hold up the summaries of the others
+            await asyncio.gather(*sends, return_exceptions=True)
+
+    def _reader_done(self, task):
+        # the next subscriber starts a new reader
+        self._reader = None
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Reader stopped', exc_info=task.exception())
+
+    async def _read(self):
+        while True:
+            if not self.channels:
+                await asyncio.sleep(0.1)
+                continue
+            try:
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except Exception:
+                # the pubsub connects again and subscribes its channels on the next read
+                logger.exception('Aggregate reader failed, reading again in %.0fs', READ_RETRY_DELAY)
+                await asyncio.sleep(READ_RETRY_DELAY)
+                continue
+            if message is None:
+                continue
+            windows = self.channels.get(message['channel'].decode('utf-8'))
+            if not windows:
+                continue
+            try:
+                frame_as_dict = json.loads(message['data'])
+            except ValueError:
+                continue
+            name = frame_as_dict.get('name')
+            kind = frame_as_dict.get('kind')
+            for window in windows:
+                if kind != window.kind or name not in window.names:
+                    continue
+                value = field_value(frame_as_dict.get('data'), window.field)
+                if value is not None:
+                    window.add(value)
+
+
+aggregate_hub = AggregateHub()
@@ -0,0 +1,324 @@
+"""
+Durable per-space frame archive.
+
+With ``archive_path`` set, every frame sent to a space is also appended to
+that space's archive, so agents can ask for history instead of keeping
+their own copies. Each space has a directory of append-only segments
+named after their first sequence number::
+
+    <archive_path>/<space uuid>/00000000000000000001.seg
+    <archive_path>/<space uuid>/00000000000000000001.idx
+
+A segment record is ``<I Q d H`` (frame size, sequence, time, name size)
+followed by the name and the frame as JSON. The ``.idx`` file next to it
+is a sparse index of ``<Q d Q`` (sequence, time, offset), one entry per
+``INDEX_INTERVAL`` bytes of segment, which lets a query jump close to its
+start time or cursor and read the rest through a memory map.
+
+Frames are appended to an in-memory batch on the relay path and written
+by a background task from a worker thread. Writers take a lock file per
+space, so several worker processes can share one archive. Old segments
+are deleted by age and by total size per space.
+"""
+import asyncio
+import fcntl
+import logging
+import mmap
+import struct
+from collections import namedtuple
+from itertools import islice
+from pathlib import Path
+from time import time
+from typing import Iterator
+from typing import Optional
+
+from .util import LRUCache
+
+logger = logging.getLogger(__name__)
+
+RECORD = struct.Struct('<IQdH')  # frame size, sequence, time, name size
+INDEX = struct.Struct('<QdQ')  # sequence, time, segment offset
+SEGMENT_SIZE = 16 * 1024 * 1024
+INDEX_INTERVAL = 4096  # bytes of segment per index entry
+FLUSH_INTERVAL = 0.2  # seconds
+PENDING_MAX = 100000  # frames waiting to be written before new ones are dropped
+RETENTION_INTERVAL = 60.0  # seconds
+SPACE_CACHE_MAX = 1024  # spaces whose archive tail is kept between writes
+
+ArchiveRecord = namedtuple('ArchiveRecord', 'seq time name frame')
+
+
+def _segment_path(directory: Path, first_seq: int) -> Path:
+    return directory.joinpath(f'{first_seq:020d}.seg')
+
+
+class SpaceArchive(object):
+    def __init__(self, directory: Path, segment_size: int = SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        self._tail_cache = None  # (segment path, size, last sequence, offset of last record)
+
+    def segments(self):
+        """Return ``(first sequence, path)`` of every segment, oldest first."""
+        segments = []
+        for path in self.directory.glob('*.seg'):
+            try:
+                segments.append((int(path.stem), path))
+            except ValueError:
+                continue
+        return sorted(segments)
+
+    def _tail(self):
+        segments = self.segments()
+        if not segments:
+            return None, 0, 0, None
+        first_seq, path = segments[-1]
+        size = path.stat().st_size
+        cached = self._tail_cache
+        if cached and cached[0] == path and cached[1] == size:
+            return cached
+        if cached and cached[0] == path and cached[1] < size:
+            # another process appended since our last write, read on from there
+            offset, seq, last_offset = cached[1], cached[2], cached[3]
+        else:
+            offset, seq, last_offset = 0, first_seq - 1, None
+        with path.open('rb') as segment:
+            segment.seek(offset)
+            data = segment.read()
+        position = 0
+        while position + RECORD.size <= len(data):
+            frame_size, record_seq, _, name_size = RECORD.unpack_from(data, position)
+            end = position + RECORD.size + name_size + frame_size
+            if end > len(data):
+                break
+            seq, last_offset = record_seq, offset + position
+            position = end
+        if offset + position < size:
+            # a write was cut short, drop the partial record before appending
+            with path.open('r+b') as segment:
+                segment.truncate(offset + position)
+        return path, offset + position, seq, last_offset
+
+    def write(self, entries):
+        """Append ``(time, name, frame as json)`` entries, called from a worker thread."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with self.directory.joinpath('lock').open('a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            path, size, seq, last_offset = self._tail()
+            data = bytearray()
+            index = bytearray()
+            for at, name, frame_as_json in entries:
+                if path is None or size >= self.segment_size:
+                    if path is not None:
+                        self._append(path, data, index)
+                        data, index = bytearray(), bytearray()
+                    path, size, last_offset = _segment_path(self.directory, seq + 1), 0, None
+                seq += 1
+                name = name.encode('utf-8')
+                frame = frame_as_json.encode('utf-8')
+                if last_offset is None or size // INDEX_INTERVAL != last_offset // INDEX_INTERVAL:
+                    index += INDEX.pack(seq, at, size)
+                data += RECORD.pack(len(frame), seq, at, len(name))
+                data += name
+                data += frame
+                last_offset = size
+                size += RECORD.size + len(name) + len(frame)
+            self._append(path, data, index)
+            self._tail_cache = (path, size, seq, last_offset)
+
+    def _append(self, path: Path, data, index):
+        with path.open('ab') as segment:
+            segment.write(data)
+        if index:
+            with path.with_suffix('.idx').open('ab') as index_file:
+                index_file.write(index)
+
+    def _start_offset(self, path: Path, after_seq: Optional[int], start: Optional[float]) -> int:
+        if after_seq is None and start is None:
+            return 0
+        offset = 0
+        try:
+            index = path.with_suffix('.idx').read_bytes()
+        except OSError:
+            return 0
+        for seq, at, entry_offset in INDEX.iter_unpack(index[:len(index) - len(index) % INDEX.size]):
+            if after_seq is not None and seq > after_seq:
+                break
+            if start is not None and at >= start:
+                break
+            offset = entry_offset
+        return offset
+
+    def read(self, after_seq: Optional[int] = None, start: Optional[float] = None,
+             end: Optional[float] = None, names=None) -> Iterator[ArchiveRecord]:
+        segments = self.segments()
+        for position, (first_seq, path) in enumerate(segments):
+            if position + 1 < len(segments):
+                next_seq = segments[position + 1][0]
+                if after_seq is not None and next_seq <= after_seq + 1:
+                    continue  # every record in this segment is before the cursor
+                try:
+                    if start is not None and path.stat().st_mtime < start:
+                        continue  # written to for the last time before the range starts
+                except OSError:
+                    continue  # removed by retention in the meantime
+            try:
+                segment = path.open('rb')
+            except OSError:
+                continue
+            with segment:
+                size = path.stat().st_size
+                if not size:
+                    continue
+                with mmap.mmap(segment.fileno(), size, access=mmap.ACCESS_READ) as data:
+                    position = self._start_offset(path, after_seq, start)
+                    while position + RECORD.size <= size:
+                        frame_size, seq, at, name_size = RECORD.unpack_from(data, position)
+                        name_start = position + RECORD.size
+                        frame_start = name_start + name_size
+                        position = frame_start + frame_size
+                        if position > size:
+                            break
+                        if end is not None and at > end:
+                            continue  # the wall clock may have stepped back, later records can still be in range
+                        if after_seq is not None and seq <= after_seq:
+                            continue
+                        if start is not None and at < start:
+                            continue
+                        name = data[name_start:frame_start].decode('utf-8')
+                        if names is not None and name not in names:
+                            continue
+                        yield ArchiveRecord(seq, at, name, data[frame_start:position].decode('utf-8'))
+
+    def enforce_retention(self, max_age: float = 0, max_size: int = 0) -> int:
+        """Delete whole segments older than ``max_age`` or beyond ``max_size`` bytes, never the newest."""
+        segments = self.segments()[:-1]
+        if not segments:
+            return 0
+        removed = 0
+        now = time()
+        total = sum(path.stat().st_size for _, path in self.segments())
+        for _, path in segments:
+            stat = path.stat()
+            too_old = max_age and stat.st_mtime < now - max_age
+            too_big = max_size and total > max_size
+            if not too_old and not too_big:
+                break
+            path.unlink()
+            path.with_suffix('.idx').unlink(missing_ok=True)
+            total -= stat.st_size
+            removed += 1
+        return removed
+
+
+class FrameArchive(object):
+    def __init__(self):
+        self.enabled = False
+        self.directory = None
+        self.segment_size = SEGMENT_SIZE
+        self.retention_age = 0.0
+        self.retention_size = 0
+        self.dropped = 0
+        self._spaces = LRUCache(maxsize=SPACE_CACHE_MAX)  # space uuid -> SpaceArchive being written
+        self._pending = {}  # space uuid -> list of (time, name, frame as json)
+        self._pending_count = 0
+        self._flush_lock = asyncio.Lock()  # one write at a time, so sequence numbers follow arrival
+        self._tasks = ()
+
+    def start(self, directory, segment_size: int = SEGMENT_SIZE, flush_interval: float = FLUSH_INTERVAL,
+              retention_age: float = 0, retention_size: int = 0):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segment_size = segment_size
+        self.retention_age = retention_age
+        self.retention_size = retention_size
+        self._tasks = (
+            asyncio.ensure_future(self._flush_loop(flush_interval)),
+            asyncio.ensure_future(self._retention_loop()),
+        )
+        self.enabled = True
+        logger.info('Archiving frames to %s', self.directory)
+
+    async def stop(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+
+    def space(self, space_uuid: str) -> SpaceArchive:
+        return SpaceArchive(self.directory.joinpath(space_uuid), self.segment_size)
+
+    def _writer(self, space_uuid: str) -> SpaceArchive:
+        # writers keep their archive, so the next write starts from the cached tail
+        space_archive = self._spaces.get(space_uuid)
+        if space_archive is None:
+            space_archive = self.space(space_uuid)
+            self._spaces.set(space_uuid, space_archive)
+        return space_archive
+
+    def append(self, space_uuid: str, name: str, frame_as_json: str):
+        if self._pending_count >= PENDING_MAX:
+            self.dropped += 1
+            return
+        self._pending.setdefault(space_uuid, []).append((time(), name, frame_as_json))
+        self._pending_count += 1
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            pending, self._pending, self._pending_count = self._pending, {}, 0
+            loop = asyncio.get_event_loop()
+            write = loop.run_in_executor(None, self._write, pending)
+            try:
+                await asyncio.shield(write)
+            except asyncio.CancelledError:
+                await write  # a cancelled flush still finishes its write before the next one starts
+                raise
+
+    def _write(self, pending):
+        for space_uuid, entries in pending.items():
+            try:
+                self._writer(space_uuid).write(entries)
+            except OSError:
+                logger.exception('Unable to archive %d frames of space %s', len(entries), space_uuid)
+
+    async def _flush_loop(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
+
+    async def _retention_loop(self):
+        if not self.retention_age and not self.retention_size:
+            return
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(RETENTION_INTERVAL)
+            removed = await loop.run_in_executor(None, self.enforce_retention)
+            if removed:
+                logger.info('Removed %d archive segments past retention', removed)
+
+    def enforce_retention(self) -> int:
+        removed = 0
+        for directory in self.directory.iterdir():
+            if directory.is_dir():
+                removed += self.space(directory.name).enforce_retention(self.retention_age, self.retention_size)
+        return removed
+
+    def query(self, space_uuid: str, **kwargs) -> Iterator[ArchiveRecord]:
+        return self.space(space_uuid).read(**kwargs)
+
+
+def take(records: Iterator[ArchiveRecord], count: int):
+    """Return up to ``count`` records, for reading a query in a worker thread in batches."""
+    return list(islice(records, count))
+
+
+frame_archive = FrameArchive()
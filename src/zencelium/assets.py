@@ -0,0 +1,125 @@
+"""
+Fingerprinted, precompressed static files.
+
+``url_for('static', filename='css/app.css')`` renders as
+``/static/css/app.<fingerprint>.css``, where the fingerprint is a hash of
+the file contents. A fingerprinted url never changes meaning, so it is
+served with an immutable, year long cache lifetime; plain or outdated urls
+still work but must be revalidated. Text files are compressed with gzip,
+and brotli when the ``brotli`` package is installed, the first time they
+are requested and kept in memory. Every response has an ETag, so
+revalidation costs a 304 instead of the file.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+from pathlib import Path
+from typing import Optional
+
+from quart import Response
+
+try:
+    import brotli
+except ImportError:  # optional, pip install zencelium[brotli]
+    brotli = None
+
+FINGERPRINT_LENGTH = 12
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+COMPRESS_MIN_SIZE = 256  # bytes, smaller files are not worth the header
+FINGERPRINTED = re.compile(r'^(?P<stem>.+)\.(?P<fingerprint>[0-9a-f]{%d})(?P<suffix>\.[^./]+)$' % FINGERPRINT_LENGTH)
+
+
+def accepted_encoding(accept_encoding: str) -> Optional[str]:
+    """Pick the best encoding we can produce from an Accept-Encoding header."""
+    accepted = set()
+    for item in accept_encoding.split(','):
+        coding, _, params = item.strip().partition(';')
+        if params.strip().replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        accepted.add(coding.strip().lower())
+    if brotli is not None and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted or '*' in accepted:
+        return 'gzip'
+    return None
+
+
+class StaticAsset(object):
+    def __init__(self, path: Path, stat: os.stat_result):
+        self.path = path
+        self.stat_key = (stat.st_mtime_ns, stat.st_size)
+        self.data = path.read_bytes()
+        self.fingerprint = hashlib.sha256(self.data).hexdigest()[:FINGERPRINT_LENGTH]
+        self.mimetype = mimetypes.guess_type(str(path))[0] or 'application/octet-stream'
+        self.compressible = len(self.data) >= COMPRESS_MIN_SIZE and self.mimetype.startswith(COMPRESSIBLE)
+        self._variants = {}  # encoding -> compressed bytes
+
+    def variant(self, encoding: Optional[str]) -> bytes:
+        if encoding is None or not self.compressible:
+            return self.data
+        data = self._variants.get(encoding)
+        if data is None:
+            if encoding == 'br':
+                data = brotli.compress(self.data)
+            else:
+                data = gzip.compress(self.data, compresslevel=9, mtime=0)
+            self._variants[encoding] = data
+        return data
+
+
+class StaticAssets(object):
+    def __init__(self, folder):
+        self.folder = Path(folder).resolve()
+        self._assets = {}  # relative file name -> StaticAsset
+
+    def get(self, filename: str) -> Optional[StaticAsset]:
+        path = (self.folder / filename).resolve()
+        if self.folder not in path.parents:
+            return None
+        try:
+            stat = path.stat()
+        except OSError:
+            return None
+        if not path.is_file():
+            return None
+        asset = self._assets.get(filename)
+        if asset is None or asset.stat_key != (stat.st_mtime_ns, stat.st_size):
+            asset = self._assets[filename] = StaticAsset(path, stat)
+        return asset
+
+    def url_filename(self, filename: str) -> str:
+        asset = self.get(filename)
+        if asset is None:
+            return filename
+        stem, suffix = os.path.splitext(filename)
+        return f'{stem}.{asset.fingerprint}{suffix}'
+
+    def lookup(self, filename: str):
+        """Return the asset for a requested file name and whether its url is immutable."""
+        match = FINGERPRINTED.match(filename)
+        if match:
+            asset = self.get(match['stem'] + match['suffix'])
+            if asset is not None:
+                return asset, asset.fingerprint == match['fingerprint']
+        return self.get(filename), False
+
+    async def response(self, filename: str, request) -> Optional[Response]:
+        asset, immutable = self.lookup(filename)
+        if asset is None:
+            return None
+        encoding = accepted_encoding(request.headers.get('Accept-Encoding', '')) if asset.compressible else None
+        response = Response(asset.variant(encoding), mimetype=asset.mimetype)
+        response.set_etag(f'{asset.fingerprint}-{encoding}' if encoding else asset.fingerprint)
+        response.headers['Cache-Control'] = IMMUTABLE if immutable else REVALIDATE
+        if asset.compressible:
+            response.vary.add('Accept-Encoding')
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        return await response.make_conditional(request)
+
+
+static_assets = StaticAssets(Path(__file__).parent.joinpath('static'))
@@ -0,0 +1,207 @@
+import asyncio
+import logging
+from bisect import bisect
+from hashlib import md5
+from time import perf_counter
+from typing import Iterable
+
+from redis.asyncio import Redis
+
+logger = logging.getLogger(__name__)
+
+REPLICAS = 160  # points per shard on the hash ring
+PUBLISH_WINDOW = 0.0  # seconds a publish may wait for others to share its round trip, 0 for none
+PUBLISH_BATCH_MAX = 256  # publishes per pipeline
+HEALTH_TIMEOUT = 2.0  # seconds a shard has to answer a health check ping
+
+
+def _hash(key: str) -> int:
+    return int(md5(key.encode('utf-8')).hexdigest()[:8], 16)
+
+
+class BrokerShards(object):
+    """Spread space and agent channels over several Redis instances.
+
+    Channels are mapped to shards with consistent hashing, so adding a shard
+    only moves the channels that land on it. Every shard has its own client
+    and connection pool. Publishers and subscribers use the same ring, so a
+    frame published to a channel reaches everyone subscribed to it.
+    """
+
+    def __init__(self, urls: Iterable[str] = ('redis://localhost',), replicas: int = REPLICAS):
+        self.urls = [url.strip() for url in urls if url.strip()]
+        if not self.urls:
+            raise ValueError('Expected at least one broker url.')
+        self.clients = [Redis.from_url(url) for url in self.urls]
+        self._ring = sorted(
+            (_hash(f'{url}#{replica}'), index)
+            for index, url in enumerate(self.urls)
+            for replica in range(replicas))
+        self._points = [point for point, _ in self._ring]
+
+    def shard_for(self, channel: str) -> int:
+        if len(self.clients) == 1:
+            return 0
+        position = bisect(self._points, _hash(channel)) % len(self._ring)
+        return self._ring[position][1]
+
+    def client_for(self, channel: str) -> Redis:
+        return self.clients[self.shard_for(channel)]
+
+    async def publish(self, channel: str, data):
+        return await self.client_for(channel).publish(channel, data)
+
+    def pubsub(self) -> 'ShardedPubSub':
+        return ShardedPubSub(self)
+
+    async def health(self, timeout: float = HEALTH_TIMEOUT):
+        # shards are pinged together, so a dead one costs the timeout only once
+        return await asyncio.gather(*(
+            self._ping(url, client, timeout) for url, client in zip(self.urls, self.clients)))
+
+    @staticmethod
+    async def _ping(url: str, client: Redis, timeout: float) -> dict:
+        start = perf_counter()
+        try:
+            await asyncio.wait_for(client.ping(), timeout)
+        except asyncio.TimeoutError:
+            return {'url': url, 'ok': False, 'error': f'No answer within {timeout:g} seconds.'}
+        except Exception as e:
+            return {'url': url, 'ok': False, 'error': str(e)}
+        return {'url': url, 'ok': True, 'latency': perf_counter() - start}
+
+    async def close(self):
+        for client in self.clients:
+            await client.close()
+
+
+class BatchPublisher(object):
+    """Publish through one pipeline per shard for everything published within a window.
+
+    Under load many agent servers publish at the same moment, and each
+    publish is a round trip of its own. Here a publish is queued for its
+    shard and sent together with the others that arrive within ``window``
+    seconds, or as soon as ``max_batch`` are queued. Every caller still
+    awaits the result of its own publish. Pipelines of a shard are sent one
+    after the other, so frames on a channel reach Redis in the order they
+    were published. A window costs every publish up to that much latency, so
+    batching is off unless ``publish_batch_window`` is set.
+    """
+
+    def __init__(self, shards: BrokerShards, window: float = PUBLISH_WINDOW, max_batch: int = PUBLISH_BATCH_MAX):
+        self.shards = shards
+        self.window = window
+        self.max_batch = max_batch
+        self.published = 0
+        self.batches = 0
+        self._pending = {}  # shard index -> list of (channel, data, future)
+        self._timers = {}  # shard index -> asyncio.TimerHandle
+        self._sending = {}  # shard index -> task sending the last batch
+
+    async def publish(self, channel: str, data):
+        loop = asyncio.get_event_loop()
+        index = self.shards.shard_for(channel)
+        future = loop.create_future()
+        pending = self._pending.setdefault(index, [])
+        pending.append((channel, data, future))
+        if len(pending) >= self.max_batch:
+            self._flush(index)
+        elif len(pending) == 1:
+            self._timers[index] = loop.call_later(self.window, self._flush, index)
+        return await future
+
+    def _flush(self, index: int):
+        timer = self._timers.pop(index, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(index, None)
+        if batch:
+            self._sending[index] = asyncio.ensure_future(self._send(index, batch, self._sending.get(index)))
+
+    async def _send(self, index: int, batch, previous):
+        if previous is not None and not previous.done():
+            await previous
+        try:
+            pipeline = self.shards.clients[index].pipeline(transaction=False)
+            for channel, data, _ in batch:
+                pipeline.publish(channel, data)
+            results = await pipeline.execute(raise_on_error=False)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            if self._sending.get(index) is asyncio.current_task():
+                del self._sending[index]
+        self.batches += 1
+        self.published += len(batch)
+        for (_, _, future), result in zip(batch, results):
+            if future.done():
+                continue  # the caller was cancelled, the frame went out anyway
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def flush(self):
+        """Send everything queued and wait until it is published."""
+        for index in list(self._pending):
+            self._flush(index)
+        if self._sending:
+            await asyncio.gather(*self._sending.values(), return_exceptions=True)
+
+
+class ShardedPubSub(object):
+    """A pubsub over all shards that subscribes each channel on its own shard.
+
+    Shard connections are opened on first use, so an agent whose channels
+    all land on one shard holds a single connection.
+    """
+
+    def __init__(self, shards: BrokerShards):
+        self.shards = shards
+        self._pubsubs = {}  # shard index -> PubSub
+        self._next = 0
+
+    def _by_shard(self, channels):
+        grouped = {}
+        for channel in channels:
+            grouped.setdefault(self.shards.shard_for(channel), []).append(channel)
+        return grouped
+
+    async def subscribe(self, *channels):
+        for index, shard_channels in self._by_shard(channels).items():
+            pubsub = self._pubsubs.get(index)
+            if pubsub is None:
+                pubsub = self._pubsubs[index] = self.shards.clients[index].pubsub()
+            await pubsub.subscribe(*shard_channels)
+
+    async def unsubscribe(self, *channels):
+        for index, shard_channels in self._by_shard(channels).items():
+            pubsub = self._pubsubs.get(index)
+            if pubsub is not None:
+                await pubsub.unsubscribe(*shard_channels)
+
+    async def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        pubsubs = [pubsub for pubsub in self._pubsubs.values() if pubsub.subscribed]
+        if not pubsubs:
+            await asyncio.sleep(min(timeout, 0.1))
+            return None
+        if len(pubsubs) == 1:
+            return await pubsubs[0].get_message(ignore_subscribe_messages, timeout)
+        # round robin so one busy shard cannot starve the others
+        for offset in range(len(pubsubs)):
+            pubsub = pubsubs[(self._next + offset) % len(pubsubs)]
+            message = await pubsub.get_message(ignore_subscribe_messages, 0.0)
+            if message is not None:
+                self._next = (self._next + offset + 1) % len(pubsubs)
+                return message
+        if timeout:
+            await asyncio.sleep(min(timeout, 0.01))
+        return None
+
+    async def close(self):
+        for pubsub in self._pubsubs.values():
+            await pubsub.close()
+        self._pubsubs.clear()
@@ -0,0 +1,223 @@
+"""
+Capture relayed traffic to a segmented binary log for replay.
+
+With capture on, every frame an agent sends over its websocket and every
+frame broadcast to spaces is appended to a log in ``capture_path``. Each
+record holds the wall clock time, the capture point, the account and
+agent names, the space names and the frame as JSON::
+
+    <d B H H I I   time, point, account, agent, spaces and frame lengths
+    account agent spaces frame   utf-8, spaces joined with commas
+
+Records are packed into an in-memory buffer on the event loop and written
+by a background task in a worker thread, so capturing costs a struct pack
+per frame. A new segment file is started when the current one is past
+``segment_size``. When the buffer fills faster than the disk can keep up,
+records are dropped and counted rather than slowing the relay down, and
+so are frames that cannot be captured at all.
+
+Login tokens are never captured. ``zencelium replay`` plays a capture
+back, see ``replay.py``.
+"""
+import asyncio
+import json
+import logging
+import struct
+from collections import namedtuple
+from pathlib import Path
+from time import time
+from typing import Iterator
+
+from .models import Account
+from .util import LRUCache
+from .util import RateLimitedLog
+
+logger = logging.getLogger(__name__)
+hot_path_logger = RateLimitedLog(logger)
+
+INGRESS = 1  # frame received by AgentServer.frame_handler
+BROADCAST = 2  # frame sent to spaces by SpaceServer.broadcast
+
+MAGIC = b'ZCAP2\n'
+HEADER = struct.Struct('<dBHHII')
+SEGMENT_SIZE = 64 * 1024 * 1024
+SEGMENT_PATTERN = 'capture-*.zcap'
+BUFFER_MAX = 16 * 1024 * 1024  # bytes buffered before records are dropped
+FLUSH_INTERVAL = 0.5  # seconds
+
+CaptureRecord = namedtuple('CaptureRecord', 'time point account agent spaces frame')
+
+
+class TrafficCapture(object):
+    def __init__(self):
+        self.enabled = False
+        self.directory = None
+        self.segment_size = SEGMENT_SIZE
+        self.records = 0
+        self.dropped = 0
+        self._buffer = bytearray()
+        self._buffer_max = BUFFER_MAX
+        self._flush_interval = FLUSH_INTERVAL
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()  # one write at a time, in the order records were buffered
+        self._file = None
+        self._file_size = 0
+        self._segment = 0
+        self._account_names = LRUCache(maxsize=1024)  # account uuid -> name
+
+    def start(self, directory, segment_size: int = SEGMENT_SIZE,
+              buffer_max: int = BUFFER_MAX, flush_interval: float = FLUSH_INTERVAL):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segment_size = segment_size
+        self._buffer_max = buffer_max
+        self._flush_interval = flush_interval
+        # continue numbering after the segments of an earlier capture
+        self._segment = max((_segment_number(path) for path in self.directory.glob(SEGMENT_PATTERN)), default=0)
+        self._flush_task = asyncio.ensure_future(self._flush_loop())
+        self.enabled = True
+        logger.info('Capturing traffic to %s', self.directory)
+
+    async def stop(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        self._flush_task.cancel()
+        try:
+            await self._flush_task
+        except asyncio.CancelledError:
+            pass
+        await self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        logger.info('Captured %d frames, dropped %d', self.records, self.dropped)
+
+    def record(self, point: int, account: str, agent: str, spaces, frame_as_json: str):
+        if len(self._buffer) >= self._buffer_max:
+            self.dropped += 1
+            return
+        account = (account or '').encode('utf-8')
+        agent = (agent or '').encode('utf-8')
+        spaces = ','.join(spaces).encode('utf-8')
+        frame = frame_as_json.encode('utf-8')
+        self._buffer += HEADER.pack(time(), point, len(account), len(agent), len(spaces), len(frame))
+        self._buffer += account + agent + spaces + frame
+        self.records += 1
+
+    def ingress(self, account, agent, spaces, frame):
+        try:
+            frame_as_dict = frame.to_dict()
+            if frame.name == 'login':
+                frame_as_dict['data'] = {}  # never write tokens to disk
+            self.record(
+                INGRESS,
+                account.name if account else '',
+                agent.name if agent else '',
+                [space.name for space in spaces],
+                json.dumps(frame_as_dict),
+            )
+        except Exception as e:
+            self._failed(INGRESS, frame, e)
+
+    def broadcast(self, frame, spaces):
+        if not spaces:
+            return
+        try:
+            source = (frame.meta or {}).get('source') or {}
+            self.record(
+                BROADCAST,
+                self._account_name(spaces[0].account_id),
+                source.get('name', ''),
+                [space.name for space in spaces],
+                frame.to_json(),
+            )
+        except Exception as e:
+            self._failed(BROADCAST, frame, e)
+
+    def _failed(self, point, frame, error):
+        # capturing is best effort, the frame is relayed either way
+        self.dropped += 1
+        hot_path_logger.warning(
+            ('capture', point, type(error)), 'Unable to capture frame %s: %r', frame.name, error)
+
+    def _account_name(self, account_uuid):
+        name = self._account_names.get(account_uuid)
+        if name is None:
+            account = Account.get_or_none(uuid=account_uuid)
+            name = account.name if account else ''
+            self._account_names.set(account_uuid, name)
+        return name
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                await self.flush()
+            except OSError:
+                logger.exception('Unable to write traffic capture, stopping it')
+                self.enabled = False
+                return
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._buffer:
+                return
+            data, self._buffer = self._buffer, bytearray()
+            loop = asyncio.get_event_loop()
+            write = loop.run_in_executor(None, self._write, data)
+            try:
+                await asyncio.shield(write)
+            except asyncio.CancelledError:
+                await write  # a cancelled flush still finishes its write before the next one starts
+                raise
+
+    def _write(self, data):
+        # buffers hold whole records, so segments never split a record
+        if self._file is None or self._file_size >= self.segment_size:
+            if self._file is not None:
+                self._file.close()
+            self._segment += 1
+            self._file = self.directory.joinpath(f'capture-{self._segment:06d}.zcap').open('wb')
+            self._file.write(MAGIC)
+            self._file_size = len(MAGIC)
+        self._file.write(data)
+        self._file.flush()
+        self._file_size += len(data)
+
+
+def _segment_number(path: Path) -> int:
+    try:
+        return int(path.stem.split('-', 1)[1])
+    except (IndexError, ValueError):
+        return 0
+
+
+def read_capture(directory) -> Iterator[CaptureRecord]:
+    """Yield the records of all segments in ``directory`` in the order they were written."""
+    for path in sorted(Path(directory).glob(SEGMENT_PATTERN), key=_segment_number):
+        with path.open('rb') as segment:
+            if segment.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'{path} is not a traffic capture segment.')
+            while True:
+                header = segment.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break  # end of segment, or a record cut short by a crash
+                at, point, account_size, agent_size, spaces_size, frame_size = HEADER.unpack(header)
+                body = segment.read(account_size + agent_size + spaces_size + frame_size)
+                if len(body) < account_size + agent_size + spaces_size + frame_size:
+                    break
+                agent_end = account_size + agent_size
+                spaces_end = agent_end + spaces_size
+                spaces = body[agent_end:spaces_end].decode('utf-8')
+                yield CaptureRecord(
+                    at,
+                    point,
+                    body[:account_size].decode('utf-8'),
+                    body[account_size:agent_end].decode('utf-8'),
+                    tuple(spaces.split(',')) if spaces else (),
+                    body[spaces_end:].decode('utf-8'),
+                )
+
+
+traffic_capture = TrafficCapture()
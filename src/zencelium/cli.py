@@ -15,7 +15,9 @@ Why does this file exist, and why not put this in __main__?
   Also see (1) from http://click.pocoo.org/5/setuptools/#setuptools-integration
 """
 import click
-from .web import run
+
+# Subcommands import what they need when they run, so ``zencelium --help``
+# does not pay for the web server, database and broker imports.
 
 
 @click.group()
@@ -23,10 +25,117 @@ def cli():
     pass
 
 
+def database_url(database):
+    """The ``--database`` option, or the database of ``zencelium run`` when it is not given."""
+    if database:
+        return database
+    from .web import config
+    from .web import configure_app
+
+    configure_app()
+    return config.database_url
+
+
 @cli.command('run')
 @click.option('--bind', default='127.0.0.1')
 @click.option('--port', default=26514, type=int)
 @click.option('--log-level', default='warning', 
               type=click.Choice(['debug', 'info', 'warning', 'fatal'], case_sensitive=False))
-def cli_run(bind, port, log_level):
-    run(bind=bind, port=port, log_level=log_level)
+@click.option('--workers', type=int, help='Server processes sharing the port.')
+@click.option('--loop', 'event_loop', type=click.Choice(['asyncio', 'uvloop']), help='Event loop implementation.')
+@click.option('--backlog', type=int, help='Pending connections the listening socket queues.')
+@click.option('--keep-alive-timeout', type=float, help='Seconds an idle http connection is kept open.')
+@click.option('--websocket-ping-interval', type=float, help='Seconds between websocket pings, 0 for none.')
+@click.option('--max-message-size', type=int, help='Largest websocket message in bytes.')
+def cli_run(bind, port, log_level, workers, event_loop, backlog, keep_alive_timeout,
+            websocket_ping_interval, max_message_size):
+    from .web import run
+
+    run(bind=bind, port=port, log_level=log_level,
+        server_workers=workers,
+        event_loop=event_loop,
+        server_backlog=backlog,
+        server_keep_alive_timeout=keep_alive_timeout,
+        websocket_ping_interval=websocket_ping_interval,
+        ingress_buffer_max_size=max_message_size)
+
+
+@cli.command('import')
+@click.argument('input_file', type=click.File('r'))
+@click.option('--database', help='Database file or url, database_url of zencelium.ini by default.')
+@click.option('--format', 'fmt', type=click.Choice(['jsonl', 'csv']))
+@click.option('--tokens', 'tokens_file', type=click.File('w'),
+              help='Write the tokens of created agents to this file.')
+def cli_import(input_file, database, fmt, tokens_file):
+    from .models import db_init
+    from .provision import guess_format
+    from .provision import import_records
+    from .provision import read_records
+    from .provision import write_records
+
+    db_init(database_url(database))
+    fmt = fmt or guess_format(input_file.name)
+    try:
+        result = import_records(read_records(input_file, fmt))
+    except ValueError as e:
+        raise click.ClickException(f'{input_file.name}: {e}')
+    if tokens_file:
+        write_records(tokens_file, result['tokens'], guess_format(tokens_file.name))
+    created = ', '.join(f'{count} {name}s' for name, count in result['created'].items())
+    click.echo(f'Created {created}, skipped {result["skipped"]} existing records.', err=True)
+
+
+@cli.command('export')
+@click.argument('output_file', type=click.File('w'))
+@click.option('--database', help='Database file or url, database_url of zencelium.ini by default.')
+@click.option('--format', 'fmt', type=click.Choice(['jsonl', 'csv']))
+def cli_export(output_file, database, fmt):
+    from .models import db_init
+    from .provision import export_records
+    from .provision import guess_format
+    from .provision import write_records
+
+    db_init(database_url(database))
+    count = write_records(output_file, export_records(), fmt or guess_format(output_file.name))
+    click.echo(f'Exported {count} records.', err=True)
+
+
+@cli.command('migrate')
+@click.option('--database', help='Database file or url, database_url of zencelium.ini by default.')
+def cli_migrate(database):
+    from .models import db_init
+
+    db_init(database_url(database))
+    click.echo('Database schema is up to date.', err=True)
+
+
+@cli.command('replay')
+@click.argument('capture_dir', type=click.Path(exists=True, file_okay=False))
+@click.option('--url', default='ws://127.0.0.1:26514/', help='Websocket url of the instance to replay against.')
+@click.option('--database', help='Database file or url of that instance, database_url of zencelium.ini by default.')
+@click.option('--speed', default=1.0, type=float, help='Replay this many times faster than captured.')
+def cli_replay(capture_dir, url, database, speed):
+    import asyncio
+
+    from .capture import read_capture
+    from .models import db_init
+    from .provision import import_records
+    from .replay import agent_tokens
+    from .replay import capture_topology
+    from .replay import replay
+    from .replay import replay_schedule
+    from .replay import topology_records
+
+    db_init(database_url(database))
+    topology, websocket_agents = capture_topology(read_capture(capture_dir))
+    result = import_records(topology_records(topology))
+    created = ', '.join(f'{count} {name}s' for name, count in result['created'].items())
+    click.echo(f'Replaying {len(topology)} agents, created {created}.', err=True)
+    tokens = agent_tokens(topology)
+    schedule = replay_schedule(read_capture(capture_dir), websocket_agents)
+    stats = asyncio.run(replay(schedule, url, tokens, speed))
+    click.echo(
+        f'Sent {stats["frames_sent"]} frames from {stats["agents"]} agents in {stats["duration"]:.2f}s '
+        f'(captured over {stats["captured_duration"]:.2f}s, at most {stats["max_lag"] * 1000:.0f} ms behind), '
+        f'received {stats["frames_received"]} messages, skipped {stats["frames_skipped"]} frames.',
+        err=True)
@@ -0,0 +1,97 @@
+import sys
+from collections import deque
+from math import ceil
+from time import monotonic
+
+BUCKETS = 6
+MAX_ENTRIES = 100000
+KEY_PREFIX = 'zencelium:dedup:'
+
+
+class FrameDeduplicator(object):
+    """Remember recently relayed frames to drop retried duplicates.
+
+    Frames are keyed on source agent and frame uuid. Keys live in a few time
+    buckets that together cover ``window`` seconds; expiring a bucket drops
+    all of its keys at once, and the oldest bucket is also dropped early when
+    more than ``max_entries`` keys are held, which bounds memory.
+
+    With ``brokers`` set, keys that are new to this process are also claimed
+    with SET NX on the broker so retries that land on another worker are
+    caught as well.
+    """
+
+    def __init__(self, window: float, brokers=None, max_entries: int = MAX_ENTRIES, buckets: int = BUCKETS):
+        self.window = window
+        self.brokers = brokers
+        self.max_entries = max_entries
+        self._span = window / buckets
+        self._buckets = deque()  # (started_at, set of keys), oldest first
+        self._entries = 0
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def _current_bucket(self, now):
+        while self._buckets and (
+                self._buckets[0][0] + self.window < now or self._entries >= self.max_entries):
+            _, expired = self._buckets.popleft()
+            self._entries -= len(expired)
+        if not self._buckets or self._buckets[-1][0] + self._span < now:
+            self._buckets.append((now, set()))
+        return self._buckets[-1][1]
+
+    async def is_duplicate(self, agent_uuid: str, frame_uuid: str) -> bool:
+        if not frame_uuid:
+            return False
+        key = f'{agent_uuid}:{frame_uuid}'
+        bucket = self._current_bucket(monotonic())
+        if any(key in keys for _, keys in self._buckets):
+            self.hits += 1
+            return True
+        bucket.add(key)
+        self._entries += 1
+        if self.brokers is not None:
+            try:
+                claimed = await self.brokers.client_for(key).set(
+                    KEY_PREFIX + key, 1, nx=True, ex=max(ceil(self.window), 1))
+            except Exception:
+                self._discard(key)  # the frame is not relayed, its retry has to go through
+                raise
+            if not claimed:
+                self.hits += 1
+                self.shared_hits += 1
+                return True
+        self.misses += 1
+        return False
+
+    async def forget(self, agent_uuid: str, frame_uuid: str):
+        """Release the key of a frame that could not be relayed, so its retry goes through."""
+        if not frame_uuid:
+            return
+        key = f'{agent_uuid}:{frame_uuid}'
+        self._discard(key)
+        if self.brokers is not None:
+            await self.brokers.client_for(key).delete(KEY_PREFIX + key)
+
+    def _discard(self, key: str):
+        for _, keys in self._buckets:
+            if key in keys:
+                keys.discard(key)
+                self._entries -= 1
+
+    def stats(self):
+        seen = self.hits + self.misses
+        memory = sum(
+            sys.getsizeof(keys) + sum(sys.getsizeof(key) for key in keys)
+            for _, keys in self._buckets)
+        return {
+            'window': self.window,
+            'hits': self.hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / seen if seen else 0.0,
+            'entries': self._entries,
+            'buckets': len(self._buckets),
+            'memory_bytes': memory,
+        }
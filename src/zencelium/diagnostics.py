@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import sys
+import threading
+import traceback
+from collections import Counter
+from time import monotonic
+from time import sleep
+
+logger = logging.getLogger(__name__)
+
+PROFILE_INTERVAL = 0.005
+PROFILE_MAX_SECONDS = 60
+
+
+class LoopLagMonitor(object):
+    """Measure how late the event loop runs scheduled callbacks.
+
+    A task on the loop wakes up every ``interval`` seconds and records how
+    late it was. A watchdog thread logs the stack of the loop thread when the
+    task has not woken up for more than ``threshold`` seconds, which points
+    at whatever is blocking the loop.
+    """
+
+    def __init__(self, interval=0.1, threshold=0.5):
+        self.interval = interval
+        self.threshold = threshold
+        self.lag_last = 0.0
+        self.lag_max = 0.0
+        self.lag_total = 0.0
+        self.ticks = 0
+        self.blocked = 0
+        self._heartbeat = monotonic()
+        self._loop_thread_id = None
+        self._task = None
+        self._watchdog = None
+        self._running = False
+
+    def start(self):
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = monotonic()
+        self._running = True
+        self._task = asyncio.ensure_future(self._measure())
+        self._watchdog = threading.Thread(
+            target=self._watch, name='loop-lag-watchdog', daemon=True)
+        self._watchdog.start()
+
+    def stop(self):
+        self._running = False
+        if self._task:
+            self._task.cancel()
+
+    async def _measure(self):
+        loop = asyncio.get_event_loop()
+        while self._running:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(loop.time() - expected, 0.0)
+            self._heartbeat = monotonic()
+            self.lag_last = lag
+            self.lag_max = max(self.lag_max, lag)
+            self.lag_total += lag
+            self.ticks += 1
+
+    def _watch(self):
+        reported = False
+        while self._running:
+            sleep(self.threshold / 2)
+            blocked_for = monotonic() - self._heartbeat - self.interval
+            if blocked_for < self.threshold:
+                reported = False
+                continue
+            if reported:
+                continue
+            reported = True
+            self.blocked += 1
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame else ''
+            logger.warning('Event loop blocked for %.3fs at:\n%s', blocked_for, stack)
+
+    def stats(self):
+        return {
+            'lag_last': self.lag_last,
+            'lag_max': self.lag_max,
+            'lag_mean': self.lag_total / self.ticks if self.ticks else 0.0,
+            'ticks': self.ticks,
+            'blocked': self.blocked,
+        }
+
+
+def _stack_key(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{frame.f_globals.get('__name__', '?')}:{code.co_name}")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def sample_stacks(thread_id, seconds, interval=PROFILE_INTERVAL) -> Counter:
+    """Sample the stack of ``thread_id`` for ``seconds``, from another thread."""
+    stacks = Counter()
+    end = monotonic() + min(seconds, PROFILE_MAX_SECONDS)
+    while monotonic() < end:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            stacks[_stack_key(frame)] += 1
+        del frame
+        sleep(interval)
+    return stacks
+
+
+def collapse_stacks(stacks: Counter) -> str:
+    """Format stacks in the collapsed format read by flamegraph.pl and speedscope."""
+    return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+
+
+loop_monitor = LoopLagMonitor()
@@ -0,0 +1,82 @@
+import json
+from typing import List
+from typing import Union
+
+from zentropi import Frame
+from zentropi import KB
+from zentropi import Kind
+
+FRAME_MAX_SIZE = 64 * KB  # largest single frame accepted from an agent
+BUFFER_MAX_SIZE = 256 * KB  # largest websocket message, including batches
+BATCH_MAX_FRAMES = 256
+NAME_MAX_LENGTH = 256
+UUID_MAX_LENGTH = 64
+
+
+class FrameError(ValueError):
+    pass
+
+
+def validate_frame_dict(frame_as_dict) -> dict:
+    if not isinstance(frame_as_dict, dict):
+        raise FrameError("Expected frame to be an object.")
+    name = frame_as_dict.get("name")
+    if not isinstance(name, str) or not name:
+        raise FrameError("Expected frame name to be a non-empty string.")
+    if len(name) > NAME_MAX_LENGTH:
+        raise FrameError(f"Frame name is longer than {NAME_MAX_LENGTH} characters.")
+    try:
+        Kind(frame_as_dict.get("kind"))
+    except ValueError:
+        raise FrameError(f"Unknown kind {frame_as_dict.get('kind')!r} in {name}")
+    uuid = frame_as_dict.get("uuid")
+    if uuid is not None and (not isinstance(uuid, str) or len(uuid) > UUID_MAX_LENGTH):
+        raise FrameError(f"Expected frame uuid to be a string of at most {UUID_MAX_LENGTH} characters.")
+    for field in ("data", "meta"):
+        value = frame_as_dict.get(field)
+        if value is not None and not isinstance(value, dict):
+            raise FrameError(f"Expected frame {field} to be an object.")
+    return frame_as_dict
+
+
+def _decode(message: Union[str, bytes], max_size: int):
+    # len() of str counts characters, encoded frames are compared on bytes
+    if isinstance(message, str):
+        message = message.encode("utf-8")
+    if len(message) > max_size:
+        raise FrameError(f"Message size ({len(message)}) is larger than {max_size} bytes.")
+    try:
+        return json.loads(message)
+    except ValueError:
+        raise FrameError("Message is not valid JSON.")
+
+
+def parse_frame(message: Union[str, bytes], max_size: int = FRAME_MAX_SIZE) -> Frame:
+    return Frame.from_dict(validate_frame_dict(_decode(message, max_size)))
+
+
+def parse_frames(
+    message: Union[str, bytes],
+    max_size: int = FRAME_MAX_SIZE,
+    buffer_max_size: int = BUFFER_MAX_SIZE,
+    max_frames: int = BATCH_MAX_FRAMES,
+) -> List[Frame]:
+    """Parse a websocket message holding either one frame or a batch of frames.
+
+    A single frame may not exceed ``max_size`` and a batch may not exceed
+    ``buffer_max_size``, both checked before anything is decoded. Every frame
+    in a batch must also fit in ``max_size`` on its own.
+    """
+    if message[:1] not in ("[", b"["):
+        return [parse_frame(message, max_size)]
+    size = len(message.encode("utf-8") if isinstance(message, str) else message)
+    frames_as_dicts = _decode(message, buffer_max_size)
+    if len(frames_as_dicts) > max_frames:
+        raise FrameError(f"Batch of {len(frames_as_dicts)} frames is larger than {max_frames} frames.")
+    if size > max_size:
+        # only a batch larger than max_size can hold a frame that is too large
+        for frame_as_dict in frames_as_dicts:
+            frame_size = len(json.dumps(frame_as_dict, separators=(",", ":"), ensure_ascii=False).encode("utf-8"))
+            if frame_size > max_size:
+                raise FrameError(f"Frame size ({frame_size}) in batch is larger than {max_size} bytes.")
+    return [Frame.from_dict(validate_frame_dict(d)) for d in frames_as_dicts]
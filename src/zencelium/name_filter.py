@@ -0,0 +1,100 @@
+from sys import intern
+from typing import Iterable
+from weakref import WeakValueDictionary
+
+_END = None  # marks a node where a pattern ends, never a valid segment
+CACHE_SIZE = 1024
+
+
+class NameFilter(object):
+    """Match frame names against dot separated patterns.
+
+    ``sensor.kitchen.temp`` matches exactly, ``*`` in the middle of a pattern
+    matches one segment and a trailing ``*`` matches everything below the
+    prefix, so ``sensor.*`` matches ``sensor.kitchen.temp``. A lone ``*``
+    matches every name.
+
+    Patterns are compiled into a trie so matching walks the segments of the
+    name once, regardless of how many patterns were added. Results are cached
+    per name as agents tend to see the same few names over and over.
+    """
+
+    def __init__(self, patterns: Iterable[str] = ()):
+        self._root = {}
+        self._patterns = set()
+        self._cache = {}
+        self.frozen = False
+        for pattern in patterns:
+            self.add(pattern)
+
+    def add(self, pattern: str):
+        if self.frozen:
+            raise TypeError("Shared name filters cannot be changed, make a new one.")
+        pattern = intern(str(pattern))
+        if pattern in self._patterns:
+            return
+        node = self._root
+        for segment in pattern.split("."):
+            node = node.setdefault(intern(segment), {})
+        node[_END] = True
+        self._patterns.add(pattern)
+        self._cache.clear()
+
+    def match(self, name: str) -> bool:
+        try:
+            return self._cache[name]
+        except KeyError:
+            pass
+        matched = self._match(self._root, name.split("."), 0)
+        if len(self._cache) >= CACHE_SIZE:
+            self._cache.clear()
+        self._cache[intern(name)] = matched
+        return matched
+
+    def _match(self, node, segments, index) -> bool:
+        if index == len(segments):
+            return _END in node
+        child = node.get(segments[index])
+        if child is not None and self._match(child, segments, index + 1):
+            return True
+        wildcard = node.get("*")
+        if wildcard is None:
+            return False
+        if _END in wildcard:
+            return True  # trailing wildcard swallows the remaining segments
+        return self._match(wildcard, segments, index + 1)
+
+    @property
+    def patterns(self):
+        return frozenset(self._patterns)
+
+    def __contains__(self, name) -> bool:
+        return self.match(name)
+
+    def __iter__(self):
+        return iter(self._patterns)
+
+    def __len__(self):
+        return len(self._patterns)
+
+    def __repr__(self):
+        return f"NameFilter({sorted(self._patterns)!r})"
+
+
+_shared_filters = WeakValueDictionary()  # frozenset of patterns -> NameFilter
+
+
+def shared_filter(patterns: Iterable[str]) -> NameFilter:
+    """Return a frozen NameFilter for ``patterns``, shared with everyone who asks for the same set.
+
+    Most agents use the same few filters, so one trie and one name cache
+    serve all of them. A shared filter cannot be changed; to add a pattern,
+    ask for a new one with the extended set.
+    """
+    key = frozenset(str(pattern) for pattern in patterns)
+    name_filter = _shared_filters.get(key)
+    if name_filter is None:
+        name_filter = NameFilter(key)
+        name_filter.frozen = True
+        _shared_filters[key] = name_filter
+    return name_filter
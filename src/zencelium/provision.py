@@ -0,0 +1,204 @@
+"""
+Bulk import and export of accounts, spaces, agents and memberships.
+
+Records are flat dicts with a ``type`` of ``account``, ``space``, ``agent``
+or ``membership``, read from and written to JSON lines or CSV::
+
+    {"type": "account", "name": "home", "password": "secret"}
+    {"type": "space", "account": "home", "name": "kitchen"}
+    {"type": "agent", "account": "home", "name": "thermostat"}
+    {"type": "membership", "account": "home", "agent": "thermostat", "space": "kitchen"}
+
+Each table is inserted with one prepared statement and ``executemany``
+over chunks of rows, inside one transaction. Records that already exist
+are skipped, so an import can be re-run. A record that names an account,
+agent or space that neither exists nor is imported fails the whole import.
+"""
+import csv
+import json
+from datetime import datetime
+from typing import Iterable
+from typing import Iterator
+
+import peewee as pw
+from bcrypt import gensalt
+from bcrypt import hashpw
+
+from .models import Account
+from .models import Agent
+from .models import AgentSpace
+from .models import Space
+from .models import db_proxy
+from .models import generate_uuid
+
+CHUNK_SIZE = 500
+RECORD_TYPES = ('account', 'space', 'agent', 'membership')
+FIELDS = ('type', 'account', 'name', 'display_name', 'password', 'password_hash', 'agent', 'space', 'token')
+
+
+def guess_format(file_name: str) -> str:
+    return 'csv' if str(file_name).lower().endswith('.csv') else 'jsonl'
+
+
+def read_records(stream, fmt: str = 'jsonl') -> Iterator[dict]:
+    if fmt == 'csv':
+        for row in csv.DictReader(stream):
+            yield {k: v for k, v in row.items() if v}
+        return
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+
+def write_records(stream, records: Iterable[dict], fmt: str = 'jsonl') -> int:
+    count = 0
+    if fmt == 'csv':
+        writer = csv.DictWriter(stream, fieldnames=FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        for count, record in enumerate(records, 1):
+            writer.writerow(record)
+        return count
+    for count, record in enumerate(records, 1):
+        stream.write(json.dumps(record) + '\n')
+    return count
+
+
+def _insert(model, rows, chunk_size):
+    # insert_many() renders SQL for every row, which dominates large imports,
+    # so render the statement once and hand each chunk of rows to executemany
+    if not rows:
+        return
+    sql, _ = model.insert(rows[0]).sql()
+    fields = [field for field in model._meta.sorted_fields if field.name in rows[0]]
+    cursor = db_proxy.cursor()
+    for chunk in pw.chunked(rows, chunk_size):
+        cursor.executemany(sql, [tuple(field.db_value(row[field.name]) for field in fields) for row in chunk])
+
+
+def import_records(records: Iterable[dict], chunk_size: int = CHUNK_SIZE) -> dict:
+    """Create everything described by ``records`` that does not exist yet.
+
+    Returns counts of created and skipped records and, under ``tokens``, an
+    agent record with the token of every agent that was created. Raises
+    ``ValueError`` naming the record number for a record that cannot be
+    imported, before anything is written.
+    """
+    by_type = {record_type: [] for record_type in RECORD_TYPES}
+    for number, record in enumerate(records, 1):
+        if record.get('type') not in by_type:
+            raise ValueError(f'Record {number}: unknown record type {record.get("type")!r} in {record!r}')
+        by_type[record['type']].append((number, record))
+
+    def field(number, record, name):
+        if not record.get(name):
+            raise ValueError(f'Record {number}: {record["type"]} without {name} in {record!r}')
+        return record[name]
+
+    def lookup(known, key, number, record, name):
+        if key not in known:
+            raise ValueError(f'Record {number}: unknown {name} {record[name]!r} in {record!r}')
+        return known[key]
+
+    now = datetime.utcnow()
+    stamps = {'created_at': now, 'modified_at': now}
+    accounts = dict(Account.select(Account.name, Account.uuid).tuples())
+    spaces = {(a, n): u for n, a, u in Space.select(Space.name, Space.account, Space.uuid).tuples()}
+    agents = {(a, n): u for n, a, u in Agent.select(Agent.name, Agent.account, Agent.uuid).tuples()}
+    memberships = set(AgentSpace.select(AgentSpace.agent, AgentSpace.space).tuples())
+    rows = {model: [] for model in (Account, Space, Agent, AgentSpace)}
+    result = {'created': dict.fromkeys(RECORD_TYPES, 0), 'skipped': 0, 'tokens': []}
+
+    def add_space(account_name, name):
+        key = (accounts[account_name], name)
+        if key in spaces:
+            return False
+        spaces[key] = generate_uuid()
+        rows[Space].append(dict(stamps, uuid=spaces[key], account=key[0], name=name))
+        result['created']['space'] += 1
+        return True
+
+    def add_agent(account_name, name, token=None):
+        key = (accounts[account_name], name)
+        if key in agents:
+            return False
+        agents[key] = generate_uuid()
+        token = token or generate_uuid()
+        rows[Agent].append(dict(stamps, uuid=agents[key], account=key[0], name=name, token=token))
+        result['created']['agent'] += 1
+        result['tokens'].append({'type': 'agent', 'account': account_name, 'name': name, 'token': token})
+        return True
+
+    def account_uuid(number, record):
+        return lookup(accounts, field(number, record, 'account'), number, record, 'account')
+
+    new_accounts = []
+    for number, record in by_type['account']:
+        name = field(number, record, 'name')
+        if name in accounts:
+            result['skipped'] += 1
+            continue
+        password = record.get('password_hash')
+        if not password:
+            # bcrypt is slow by design, export hashes to move accounts in bulk
+            password = field(number, record, 'password')
+            password = hashpw(Account._encode_password(password), gensalt()).decode('utf-8')
+        accounts[name] = generate_uuid()
+        rows[Account].append(dict(
+            stamps, uuid=accounts[name], name=name, last_login=now,
+            display_name=record.get('display_name') or name, password=password))
+        result['created']['account'] += 1
+        new_accounts.append(name)
+
+    for number, record in by_type['space']:
+        account_uuid(number, record)
+        if not add_space(record['account'], field(number, record, 'name')):
+            result['skipped'] += 1
+
+    for number, record in by_type['agent']:
+        account_uuid(number, record)
+        if not add_agent(record['account'], field(number, record, 'name'), record.get('token')):
+            result['skipped'] += 1
+
+    # every account has an agent and a space of the same name, see Account.create_account,
+    # unless the import already described them
+    for name in new_accounts:
+        add_agent(name, name)
+        add_space(name, name)
+
+    for number, record in by_type['membership']:
+        account = account_uuid(number, record)
+        key = (
+            lookup(agents, (account, field(number, record, 'agent')), number, record, 'agent'),
+            lookup(spaces, (account, field(number, record, 'space')), number, record, 'space'),
+        )
+        if key in memberships:
+            result['skipped'] += 1
+            continue
+        memberships.add(key)
+        rows[AgentSpace].append(dict(stamps, uuid=generate_uuid(), agent=key[0], space=key[1]))
+        result['created']['membership'] += 1
+
+    with db_proxy.atomic():
+        for model, model_rows in rows.items():
+            _insert(model, model_rows, chunk_size)
+    return result
+
+
+def export_records() -> Iterator[dict]:
+    accounts = {}
+    for uuid, name, display_name, password in (
+            Account.select(Account.uuid, Account.name, Account.display_name, Account.password).tuples()):
+        accounts[uuid] = name
+        yield {'type': 'account', 'name': name, 'display_name': display_name, 'password_hash': password}
+    for account, name in Space.select(Space.account, Space.name).tuples():
+        yield {'type': 'space', 'account': accounts[account], 'name': name}
+    for account, name, token in Agent.select(Agent.account, Agent.name, Agent.token).tuples():
+        yield {'type': 'agent', 'account': accounts[account], 'name': name, 'token': token}
+    query = (AgentSpace
+        .select(Agent.account, Agent.name, Space.name)
+        .join(Agent, on=(AgentSpace.agent == Agent.uuid))
+        .switch(AgentSpace)
+        .join(Space, on=(AgentSpace.space == Space.uuid))
+        .tuples())
+    for account, agent_name, space_name in query:
+        yield {'type': 'membership', 'account': accounts[account], 'agent': agent_name, 'space': space_name}
@@ -0,0 +1,232 @@
+"""
+Replay a traffic capture against a running zencelium.
+
+The accounts, agents, spaces and memberships seen in the capture are
+created in the target database when they are missing. Every agent then
+connects over a websocket when it first shows up in the capture, logs in
+with its token, joins the spaces it was in at that time and sends its
+frames at their captured offsets divided by ``speed``. Broadcasts that did
+not come through a websocket, such as frames posted to the REST api, are
+sent over the websocket of their source agent.
+"""
+import asyncio
+import json
+import logging
+import ssl
+from time import monotonic
+from typing import Dict
+from typing import Iterable
+from typing import Tuple
+from urllib.parse import urlsplit
+
+from wsproto import ConnectionType
+from wsproto import WSConnection
+from wsproto.events import AcceptConnection
+from wsproto.events import CloseConnection
+from wsproto.events import Ping
+from wsproto.events import RejectConnection
+from wsproto.events import Request
+from wsproto.events import TextMessage
+
+from zentropi import Kind
+
+from .capture import BROADCAST
+from .capture import INGRESS
+from .capture import CaptureRecord
+from .models import Account
+from .models import Agent
+from .models import generate_uuid
+
+logger = logging.getLogger(__name__)
+
+LOGIN_TIMEOUT = 10.0
+SETTLE_TIME = 1.0  # seconds to keep reading after the last frame was sent
+
+AgentKey = Tuple[str, str]  # (account name, agent name)
+
+
+def capture_topology(records: Iterable[CaptureRecord]):
+    """Return the spaces every agent in the capture was in or sent to,
+    and the set of agents that sent frames over a websocket.
+    """
+    topology = {}
+    websocket_agents = set()
+    for record in records:
+        if not record.account or not record.agent:
+            continue
+        spaces = topology.setdefault((record.account, record.agent), set())
+        spaces.update(record.spaces)
+        if record.point == INGRESS:
+            websocket_agents.add((record.account, record.agent))
+            frame = json.loads(record.frame)
+            if frame.get('name') == 'join' and isinstance(frame.get('data'), dict):
+                joined = frame['data'].get('spaces') or []
+                if isinstance(joined, str):
+                    joined = [name.strip() for name in joined.split(',')]
+                spaces.update(name for name in joined if name != '*')
+    return topology, websocket_agents
+
+
+def topology_records(topology: Dict[AgentKey, set]):
+    """Provisioning records, see ``provision.py``, that recreate a capture topology."""
+    accounts = sorted({account for account, _ in topology})
+    for account in accounts:
+        # replayed accounts are only ever used through agent tokens
+        yield {'type': 'account', 'name': account, 'password': generate_uuid()}
+    for account, space in sorted({(account, space) for (account, _), spaces in topology.items() for space in spaces}):
+        yield {'type': 'space', 'account': account, 'name': space}
+    for (account, agent), spaces in sorted(topology.items()):
+        yield {'type': 'agent', 'account': account, 'name': agent}
+        for space in sorted(spaces):
+            yield {'type': 'membership', 'account': account, 'agent': agent, 'space': space}
+
+
+def agent_tokens(keys: Iterable[AgentKey]) -> Dict[AgentKey, str]:
+    keys = set(keys)
+    query = (Agent
+        .select(Account.name, Agent.name, Agent.token)
+        .join(Account)
+        .where(Account.name.in_({account for account, _ in keys}))
+        .tuples())
+    return {(account, agent): token for account, agent, token in query if (account, agent) in keys}
+
+
+def replay_schedule(records: Iterable[CaptureRecord], websocket_agents: set):
+    """Yield ``(time, agent key, spaces, frame as json)`` in capture order."""
+    for record in records:
+        key = (record.account, record.agent)
+        if record.point == INGRESS:
+            if json.loads(record.frame).get('name') == 'login':
+                continue  # replay agents log in with their own token
+            yield record.time, key, record.spaces, record.frame
+        elif record.point == BROADCAST and key not in websocket_agents and record.agent:
+            frame = json.loads(record.frame)
+            meta = frame.get('meta') or {}
+            meta.pop('source', None)
+            meta.pop('timestamp', None)
+            meta['spaces'] = list(record.spaces)
+            frame['meta'] = meta
+            yield record.time, key, (), json.dumps(frame)
+
+
+class ReplayConnection(object):
+    """A minimal websocket client for one replayed agent."""
+
+    def __init__(self, url: str):
+        self.url = urlsplit(url)
+        self.connection = WSConnection(ConnectionType.CLIENT)
+        self.reader = None
+        self.writer = None
+        self.received = 0
+        self._accepted = None
+        self._logged_in = None
+        self._read_task = None
+
+    async def open(self, token: str, spaces):
+        loop = asyncio.get_event_loop()
+        self._accepted = loop.create_future()
+        self._logged_in = loop.create_future()
+        secure = self.url.scheme == 'wss'
+        port = self.url.port or (443 if secure else 80)
+        self.reader, self.writer = await asyncio.open_connection(
+            self.url.hostname, port, ssl=ssl.create_default_context() if secure else None)
+        self._read_task = asyncio.ensure_future(self._read())
+        self.writer.write(self.connection.send(Request(host=self.url.netloc, target=self.url.path or '/')))
+        await asyncio.wait_for(self._accepted, LOGIN_TIMEOUT)
+        await self.send(json.dumps(
+            {'kind': int(Kind.COMMAND), 'name': 'login', 'uuid': generate_uuid(), 'data': {'token': token}}))
+        await asyncio.wait_for(self._logged_in, LOGIN_TIMEOUT)
+        if spaces:
+            await self.send(json.dumps(
+                {'kind': int(Kind.COMMAND), 'name': 'join', 'uuid': generate_uuid(), 'data': {'spaces': list(spaces)}}))
+
+    async def send(self, frame_as_json: str):
+        self.writer.write(self.connection.send(TextMessage(data=frame_as_json)))
+        await self.writer.drain()
+
+    async def _read(self):
+        message = []
+        while True:
+            data = await self.reader.read(65536)
+            self.connection.receive_data(data or None)
+            for event in self.connection.events():
+                if isinstance(event, AcceptConnection):
+                    self._accepted.set_result(True)
+                elif isinstance(event, RejectConnection):
+                    self._accepted.set_exception(ConnectionError(f'Websocket rejected with {event.status_code}'))
+                    return
+                elif isinstance(event, TextMessage):
+                    message.append(event.data)
+                    if event.message_finished:
+                        self._received(''.join(message))
+                        message = []
+                elif isinstance(event, Ping):
+                    self.writer.write(self.connection.send(event.response()))
+                elif isinstance(event, CloseConnection):
+                    return
+            if not data:
+                return
+
+    def _received(self, text):
+        self.received += 1
+        if self._logged_in.done():
+            return
+        name = json.loads(text).get('name') if text.startswith('{') else None
+        if name == 'login-ok':
+            self._logged_in.set_result(True)
+        elif name == 'login-failed':
+            self._logged_in.set_exception(ConnectionError('Login failed'))
+
+    async def close(self):
+        if self._read_task is not None:
+            self._read_task.cancel()
+        if self.writer is not None:
+            try:
+                self.writer.write(self.connection.send(CloseConnection(code=1000)))
+            except Exception:
+                pass  # the server may have closed the websocket already
+            self.writer.close()
+
+
+async def replay(schedule, url: str, tokens: Dict[AgentKey, str], speed: float = 1.0) -> dict:
+    connections = {}
+    failed = set()
+    stats = {'frames_sent': 0, 'frames_skipped': 0, 'max_lag': 0.0, 'captured_duration': 0.0}
+    first_at = None
+    start = monotonic()
+    try:
+        for at, key, spaces, frame_as_json in schedule:
+            if first_at is None:
+                first_at = at
+            stats['captured_duration'] = at - first_at
+            delay = (at - first_at) / speed - (monotonic() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                stats['max_lag'] = max(stats['max_lag'], -delay)
+            connection = connections.get(key)
+            if connection is None:
+                token = tokens.get(key)
+                if token is None or key in failed:
+                    stats['frames_skipped'] += 1
+                    continue
+                connection = ReplayConnection(url)
+                try:
+                    await connection.open(token, spaces)
+                except (ConnectionError, OSError, asyncio.TimeoutError) as e:
+                    logger.warning('Unable to connect agent %s of account %s: %s', key[1], key[0], e)
+                    await connection.close()
+                    failed.add(key)
+                    stats['frames_skipped'] += 1
+                    continue
+                connections[key] = connection
+            await connection.send(frame_as_json)
+            stats['frames_sent'] += 1
+        stats['duration'] = monotonic() - start
+        await asyncio.sleep(SETTLE_TIME)
+    finally:
+        for connection in connections.values():
+            await connection.close()
+    stats['agents'] = len(connections)
+    stats['frames_received'] = sum(connection.received for connection in connections.values())
+    return stats
@@ -1,14 +1,24 @@
+import asyncio
 import logging
+from random import uniform
 from typing import Iterable
-from redis.asyncio import Redis
+from weakref import WeakValueDictionary
 
 from zentropi import Frame
 from zentropi import Kind
 
 from .models import Agent
 from .models import Space
+from .archive import frame_archive
+from .broker import BatchPublisher
+from .broker import BrokerShards
+from .capture import traffic_capture
+from .dedup import FrameDeduplicator
 from .models import Account
+from .util import LRUCache
 from .util import add_space_to_meta
+from .util import clean_space_names
+from .util import target_agent_name
 
 logger = logging.getLogger(__name__)
 
@@ -16,27 +26,85 @@ logger = logging.getLogger(__name__)
 class SpaceServer(object):
     def __init__(self):
         self.agent_servers = {}
-
-    async def init(self):
-        self.publisher = await Redis.from_url("redis://localhost")
+        self.draining = False
+        self.agent_uuids = LRUCache(maxsize=4096, ttl=60)  # (account, name) -> uuid
+        self.deduplicator = None
+        self.spaces = WeakValueDictionary()  # uuid -> Space shared by all agent servers
+
+    async def init(
+        self,
+        broker_urls: Iterable[str] = ("redis://localhost",),
+        dedup_window: float = 0,
+        dedup_shared: bool = True,
+        publish_window: float = 0,
+        publish_batch_size: int = 1,
+    ):
+        self.brokers = BrokerShards(broker_urls)
+        if publish_window > 0 and publish_batch_size > 1:
+            self.publisher = BatchPublisher(self.brokers, publish_window, publish_batch_size)
+        else:
+            self.publisher = self.brokers
+        if dedup_window > 0:
+            self.deduplicator = FrameDeduplicator(
+                dedup_window, brokers=self.brokers if dedup_shared else None
+            )
+
+    def intern_space(self, space: Space) -> Space:
+        # agents of an account join the same few spaces, keep one copy of each
+        return self.spaces.setdefault(space.uuid, space)
+
+    async def is_duplicate(self, frame: Frame, agent: Agent) -> bool:
+        if self.deduplicator is None:
+            return False
+        return await self.deduplicator.is_duplicate(agent.uuid, frame.uuid)
+
+    async def forget_frame(self, frame: Frame, agent: Agent):
+        # called when relaying failed, the retry of the frame is not a duplicate
+        if self.deduplicator is None:
+            return
+        try:
+            await self.deduplicator.forget(agent.uuid, frame.uuid)
+        except Exception:
+            logger.exception("Unable to release frame %s of agent %s for a retry", frame.uuid, agent.name)
 
     async def agent_server_add(self, agent: Agent, agent_server):
-        if agent.uuid in self.agent_servers:
-            raise ConnectionError(f"Agent {agent.name} is already connected.")
+        existing = self.agent_servers.get(agent.uuid)
+        if existing is not None and existing is not agent_server:
+            # a client that reconnects before its old, half-open connection was
+            # noticed takes over once the old one has been quiet for a while
+            if not existing.replaceable():
+                raise ConnectionError(f"Agent {agent.name} is already connected.")
+            logger.info("Reap agent %s, replaced by a new connection", agent.name)
+            await existing.stop()
         self.agent_servers.update({agent.uuid: agent_server})
 
-    async def agent_server_remove(self, agent: Agent):
+    async def agent_server_remove(self, agent: Agent, agent_server=None):
         if agent.uuid not in self.agent_servers:
             raise KeyError(f"Agent {agent.name} is not connected.")
+        if agent_server is not None and self.agent_servers[agent.uuid] is not agent_server:
+            return  # already replaced by a newer connection
         del self.agent_servers[agent.uuid]
 
+    def connections(self):
+        """Describe every live agent connection and count subscribers per space."""
+        connections = []
+        subscribers = {}
+        for agent_server in list(self.agent_servers.values()):
+            connections.append(agent_server.describe())
+            for space in agent_server.spaces:
+                # names are only unique within an account, so count by uuid
+                if space.uuid not in subscribers:
+                    subscribers[space.uuid] = {"name": space.name, "subscribers": 0}
+                subscribers[space.uuid]["subscribers"] += 1
+        return {"connections": connections, "spaces": subscribers}
+
     async def agent_is_connected(self, agent: Agent):
         return agent.uuid in self.agent_servers
 
     async def agent_spaces_update(self, agent: Agent, spaces: Iterable[Space]):
         if agent.uuid not in self.agent_servers:
             raise KeyError(f"Agent {agent.name} is not connected.")
-        self.agent_servers[agent.uuid].spaces = spaces
+        self.agent_servers[agent.uuid].spaces = frozenset(self.intern_space(space) for space in spaces)
 
     async def agent_join(self, agent: Agent, spaces: Iterable[Space]):
         if agent.uuid not in self.agent_servers:
@@ -53,19 +121,99 @@ class SpaceServer(object):
             raise KeyError(f"Agent {agent.name} is not connected.")
         await self.agent_servers[agent.uuid].stop()
 
+    async def drain(self, timeout: float, reconnect_delay: float):
+        self.draining = True
+        agent_servers = list(self.agent_servers.values())
+        if not agent_servers:
+            return
+        logger.info(f"Draining {len(agent_servers)} agent connections")
+        # spread reconnects so agents do not all come back at the same moment
+        tasks = [
+            asyncio.create_task(agent_server.drain(uniform(0, reconnect_delay)))
+            for agent_server in agent_servers
+        ]
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning(f"Drain timed out for {len(pending)} agent connections")
+
+    async def flush(self):
+        # batched publishes still waiting for their window
+        if isinstance(self.publisher, BatchPublisher):
+            await self.publisher.flush()
+
     async def send_to_agent(self, frame: Frame, agent: Agent):
         if agent.uuid not in self.agent_servers:
             raise KeyError(f"Agent {agent.name} is not connected?")
         await self.publisher.publish(agent.uuid, frame.to_json())
 
-    async def send_to_space(self, frame: Frame, space: Space):
+    def resolve_agent(self, account: Account, name: str):
+        key = (account.uuid, name)
+        agent_uuid = self.agent_uuids.get(key)
+        if agent_uuid is None:
+            agent = Agent.get_or_none(name=name, account=account)
+            if agent is None:
+                return None
+            agent_uuid = agent.uuid
+            self.agent_uuids.set(key, agent_uuid)
+        return agent_uuid
+
+    def forget_agent(self, agent: Agent):
+        self.agent_uuids.pop((agent.account_id, agent.name))
+
+    async def unicast(self, frame: Frame, account: Account, agent_name: str) -> bool:
+        # the target may be connected to another worker, publish to its channel regardless
+        agent_uuid = self.resolve_agent(account, agent_name)
+        if agent_uuid is None:
+            return False
+        await self.publisher.publish(agent_uuid, frame.to_json())
+        return True
+
+    async def relay(self, frame: Frame, agent: Agent) -> bool:
+        """Relay a frame an agent sent without a websocket, over http or udp.
+
+        Returns False when the frame targets an agent that does not exist.
+        """
+        meta = {"source": {"name": agent.name}}
+        if frame.meta:
+            frame._meta.update(meta)
+        else:
+            frame._meta = meta
+        target = target_agent_name(frame)
+        if target:
+            return await self.unicast(frame, agent.account, target)
+        if frame.meta.get("spaces"):
+            space_names = clean_space_names(frame.meta.get("spaces"))
+            spaces = Space.select().where(Space.name.in_(space_names), Space.account == agent.account)
+        else:
+            spaces = agent.spaces()
+        try:
+            await self.broadcast(frame, spaces)
+        except KeyError:
+            pass
+        return True
+
+    def _space_message(self, frame: Frame, space: Space) -> str:
         add_space_to_meta(frame, space_name=space.name, space_uuid=space.uuid)
-        await self.publisher.publish(space.uuid, frame.to_json())
+        frame_as_json = frame.to_json()
+        if frame_archive.enabled:
+            frame_archive.append(space.uuid, frame.name, frame_as_json)
+        return frame_as_json
+
+    async def send_to_space(self, frame: Frame, space: Space):
+        await self.publisher.publish(space.uuid, self._space_message(frame, space))
 
     async def broadcast(self, frame: Frame, spaces: Iterable[Space]):
+        if traffic_capture.enabled:
+            spaces = list(spaces)
+            traffic_capture.broadcast(frame, spaces)
+        # every space is published at once, so they share one batch window
+        publishes = []
         for space in spaces:
-            logger.debug(f"Sending frame {frame.name} to space {space.name}")
-            await self.send_to_space(frame, space)
+            logger.debug("Sending frame %s to space %s", frame.name, space.name)
+            publishes.append(self.publisher.publish(space.uuid, self._space_message(frame, space)))
+        await asyncio.gather(*publishes)
 
 
 space_server = SpaceServer()
@@ -0,0 +1,157 @@
+import asyncio
+import json
+import logging
+from collections import deque
+from typing import Callable
+from typing import Dict
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+HISTORY_SIZE = 1024  # frames kept per channel for Last-Event-ID resume
+QUEUE_SIZE = 1024  # frames buffered per subscriber before it is disconnected
+LINGER = 30.0  # seconds a channel stays subscribed after its last subscriber left
+READ_RETRY_DELAY = 1.0  # seconds to wait after the broker failed before reading again
+
+
+class StreamSubscription(object):
+    def __init__(self, channels: Dict[str, str], accept: Callable[[int, str], bool]):
+        self.channels = channels  # channel -> space name
+        self.accept = accept
+        self.queue = asyncio.Queue(QUEUE_SIZE)
+        self.overflowed = False
+
+    def put(self, entry):
+        try:
+            self.queue.put_nowait(entry)
+        except asyncio.QueueFull:
+            # the consumer resumes from history with Last-Event-ID when it reconnects
+            self.overflowed = True
+            self.queue = None
+
+    async def get(self, timeout: float):
+        if self.queue is None:
+            return None
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return ()
+
+
+class StreamHub(object):
+    """Share one broker subscription between all read-only stream consumers.
+
+    Frames are decoded once per process and handed to the queue of every
+    local subscriber of the channel. Each entry gets a sequence number that
+    is used as the Server-Sent Events id, and the last frames of every
+    channel are kept so consumers can resume with Last-Event-ID.
+
+    Sequence numbers and history belong to this process. A consumer that
+    reconnects to another worker, or after a restart, cannot resume and
+    gets only new frames; a Last-Event-ID this hub never issued is ignored.
+    """
+
+    def __init__(self):
+        self.subscribers = {}  # channel -> set of StreamSubscription
+        self.history = {}  # channel -> deque of entries
+        self.seq = 0
+        self.pubsub = None
+        self._reader = None
+        self._lingering = {}
+        self._subscribe_lock = asyncio.Lock()  # keeps SUBSCRIBE and UNSUBSCRIBE in order
+
+    async def init(self, brokers):
+        self.pubsub = brokers.pubsub()
+
+    async def subscribe(self, channels: Dict[str, str], accept, last_event_id: Optional[int] = None):
+        subscription = StreamSubscription(channels, accept)
+        new_channels = []
+        for channel in channels:
+            handle = self._lingering.pop(channel, None)
+            if handle:
+                handle.cancel()
+            if channel not in self.subscribers:
+                self.subscribers[channel] = set()
+                new_channels.append(channel)
+            self.subscribers[channel].add(subscription)
+        if last_event_id is not None and last_event_id <= self.seq:
+            backlog = [
+                entry
+                for channel in channels
+                for entry in self.history.get(channel, ())
+                if entry[0] > last_event_id
+            ]
+            for entry in sorted(backlog, key=lambda entry: entry[0]):
+                if accept(entry[1], entry[2]):
+                    subscription.put(entry)
+        if new_channels:
+            async with self._subscribe_lock:
+                await self.pubsub.subscribe(*new_channels)
+        if self._reader is None:
+            self._reader = asyncio.ensure_future(self._read())
+            self._reader.add_done_callback(self._reader_done)
+        return subscription
+
+    async def unsubscribe(self, subscription: StreamSubscription):
+        loop = asyncio.get_event_loop()
+        for channel in subscription.channels:
+            subscribers = self.subscribers.get(channel)
+            if subscribers is None:
+                continue
+            subscribers.discard(subscription)
+            if not subscribers and channel not in self._lingering:
+                self._lingering[channel] = loop.call_later(LINGER, self._expire, channel)
+
+    def _expire(self, channel):
+        self._lingering.pop(channel, None)
+        if self.subscribers.get(channel):
+            return
+        self.subscribers.pop(channel, None)
+        self.history.pop(channel, None)
+        asyncio.ensure_future(self._unsubscribe(channel))
+
+    async def _unsubscribe(self, channel):
+        async with self._subscribe_lock:
+            if channel in self.subscribers:
+                return  # subscribed again while this was waiting to run
+            await self.pubsub.unsubscribe(channel)
+
+    def _reader_done(self, task):
+        # the next subscriber starts a new reader
+        self._reader = None
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Reader stopped", exc_info=task.exception())
+
+    async def _read(self):
+        while True:
+            if not self.subscribers:
+                await asyncio.sleep(0.1)
+                continue
+            try:
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except Exception:
+                # the pubsub connects again and subscribes its channels on the next read
+                logger.exception("Stream reader failed, reading again in %.0fs", READ_RETRY_DELAY)
+                await asyncio.sleep(READ_RETRY_DELAY)
+                continue
+            if message is None:
+                continue
+            channel = message["channel"].decode("utf-8")
+            data = message["data"].decode("utf-8")
+            try:
+                frame_as_dict = json.loads(data)
+            except ValueError:
+                logger.warning("Skip undecodable frame on channel %s", channel)
+                continue
+            self.seq += 1
+            entry = (self.seq, frame_as_dict.get("kind"), frame_as_dict.get("name"), data)
+            history = self.history.get(channel)
+            if history is None:
+                history = self.history[channel] = deque(maxlen=HISTORY_SIZE)
+            history.append(entry)
+            for subscription in list(self.subscribers.get(channel, ())):
+                if subscription.accept(entry[1], entry[2]):
+                    subscription.put(entry)
+
+
+stream_hub = StreamHub()
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+from math import ceil
+
+logger = logging.getLogger(__name__)
+
+RESOLUTION = 1.0  # seconds per tick
+SLOTS = 512
+
+
+class TimerHandle(object):
+    __slots__ = ('callback', 'args', 'laps', 'cancelled')
+
+    def __init__(self, callback, args, laps):
+        self.callback = callback
+        self.args = args
+        self.laps = laps
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel(object):
+    """Run many coarse timeouts from a single task.
+
+    Timers are hashed into ``slots`` buckets by the tick they are due on,
+    together with the number of laps around the wheel still to go. One task
+    advances the wheel every ``resolution`` seconds and runs the callbacks
+    that are due, so scheduling and cancelling are O(1) and a hundred
+    thousand idle connections share one sleeping task instead of having
+    one each. Callbacks run on the event loop and must not block; they are
+    late by at most one tick.
+    """
+
+    def __init__(self, resolution: float = RESOLUTION, slots: int = SLOTS):
+        self.resolution = resolution
+        self.slots = slots
+        self.scheduled = 0
+        self._buckets = [[] for _ in range(slots)]
+        self._tick = 0
+        self._task = None
+
+    def schedule(self, delay: float, callback, *args) -> TimerHandle:
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        ticks = max(int(ceil(delay / self.resolution)), 1)
+        handle = TimerHandle(callback, args, (ticks - 1) // self.slots)
+        self._buckets[(self._tick + ticks) % self.slots].append(handle)
+        self.scheduled += 1
+        return handle
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _advance(self):
+        self._tick += 1
+        index = self._tick % self.slots
+        waiting = []
+        due = []
+        for handle in self._buckets[index]:
+            if handle.cancelled:
+                self.scheduled -= 1
+            elif handle.laps:
+                handle.laps -= 1
+                waiting.append(handle)
+            else:
+                due.append(handle)
+        self._buckets[index] = waiting
+        self.scheduled -= len(due)
+        for handle in due:
+            try:
+                handle.callback(*handle.args)
+            except Exception:
+                logger.exception('Timer callback %r failed', handle.callback)
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        next_at = loop.time()
+        while True:
+            next_at += self.resolution
+            await asyncio.sleep(max(next_at - loop.time(), 0))
+            # catch up on the ticks missed while the loop was busy
+            behind = int((loop.time() - next_at) // self.resolution)
+            for _ in range(max(behind, 0) + 1):
+                self._advance()
+            next_at += max(behind, 0) * self.resolution
+
+
+timer_wheel = TimerWheel()
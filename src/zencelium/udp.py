@@ -0,0 +1,225 @@
+"""
+Single-frame UDP ingest for constrained agents.
+
+With ``udp_port`` set, zencelium also listens for datagrams that each carry
+one frame, so a sensor can send a reading in one packet instead of a TCP
+and TLS handshake plus an HTTP request. A datagram is::
+
+    <B 16s Q   version, agent uuid as 16 bytes, counter
+    frame      the frame as JSON, as posted to /api/frame/
+    tag        first 16 bytes of HMAC-SHA256 over everything before it
+
+The HMAC key is derived from the agent token with ``udp_key``, so the
+token itself never goes over the air. The counter is the send time in
+milliseconds since the epoch: it must be within ``REPLAY_WINDOW`` of the
+server clock and larger than the last counter accepted from that agent, so
+a captured datagram cannot be sent again. Senders without a clock may use
+any increasing counter as long as it stays within the window. The last
+counter is kept on the broker and advanced with an atomic compare-and-set,
+so a replay is caught by whichever worker process receives it.
+
+Datagrams are rate limited per source address before they are
+authenticated and per agent after, and are never answered, so the listener
+cannot be used to amplify traffic. Accepted frames take the same relay
+path as frames posted to ``/api/frame/``.
+"""
+import asyncio
+import hmac
+import logging
+import struct
+from hashlib import sha256
+from math import ceil
+from time import time
+from typing import Optional
+from typing import Tuple
+
+from zentropi import Frame
+
+from .ingress import FRAME_MAX_SIZE
+from .ingress import FrameError
+from .ingress import parse_frame
+from .models import Agent
+from .space_server import space_server
+from .util import LRUCache
+from .util import RateLimitedLog
+
+logger = logging.getLogger(__name__)
+hot_path_logger = RateLimitedLog(logger)
+
+VERSION = 1
+HEADER = struct.Struct('>B16sQ')  # version, agent uuid, counter
+TAG_SIZE = 16
+KEY_CONTEXT = b'zencelium-udp-v1'
+REPLAY_WINDOW = 30.0  # seconds a counter may be off from the server clock
+AGENT_CACHE_TTL = 60.0  # seconds before a cached agent and key are looked up again
+AGENT_RATE = 10.0  # datagrams per second and agent
+AGENT_BURST = 20
+ADDRESS_RATE = 100.0  # datagrams per second and source address
+ADDRESS_BURST = 200
+COUNTER_KEY_PREFIX = 'zencelium:udp:counter:'
+
+# Store ARGV[1] as the last counter of KEYS[1] if it is larger than the
+# stored one. Counters outside the replay window are refused before this
+# runs, so the key only has to outlive the window.
+CLAIM_COUNTER = """
+local last = tonumber(redis.call('GET', KEYS[1]))
+if last and last >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return 1
+"""
+
+
+class DatagramError(ValueError):
+    def __init__(self, reason: str, message: str = ''):
+        super().__init__(message or reason)
+        self.reason = reason  # one per kind of error, unlike the message
+
+
+def udp_key(token: str) -> bytes:
+    return hmac.new(token.encode('utf-8'), KEY_CONTEXT, sha256).digest()
+
+
+def pack_datagram(agent_uuid: str, token: str, frame_as_json: str, counter: Optional[int] = None) -> bytes:
+    """Build a datagram the way an agent would, see the module docstring."""
+    if counter is None:
+        counter = int(time() * 1000)
+    body = HEADER.pack(VERSION, bytes.fromhex(agent_uuid), counter) + frame_as_json.encode('utf-8')
+    return body + hmac.new(udp_key(token), body, sha256).digest()[:TAG_SIZE]
+
+
+class TokenBucket(object):
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: int, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+    def take(self, now: float) -> bool:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class UdpIngest(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.address = None
+        self.reuse_port = False  # several worker processes share the port
+        self.frame_max_size = FRAME_MAX_SIZE
+        self.agent_rate = AGENT_RATE
+        self.address_rate = ADDRESS_RATE
+        self.transport = None
+        self.stats = {
+            'received': 0, 'relayed': 0, 'rejected': 0, 'replayed': 0, 'rate_limited': 0, 'duplicates': 0}
+        self._agents = LRUCache(maxsize=100000, ttl=AGENT_CACHE_TTL)  # uuid -> (agent or None, key)
+        self._agent_buckets = LRUCache(maxsize=100000)
+        self._address_buckets = LRUCache(maxsize=100000)
+
+    async def start(self):
+        loop = asyncio.get_event_loop()
+        await loop.create_datagram_endpoint(
+            lambda: self, local_addr=self.address, reuse_port=self.reuse_port or None)
+        logger.info('Listening for frames on udp %s:%d', *self.address)
+
+    def stop(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.transport = None
+
+    def datagram_received(self, data: bytes, addr):
+        self.stats['received'] += 1
+        now = time()
+        if not self._take(self._address_buckets, addr[0], self.address_rate, ADDRESS_BURST, now):
+            self.stats['rate_limited'] += 1
+            return
+        try:
+            agent, counter, frame = self.verify(data, now)
+        except DatagramError as e:
+            self.stats['rejected'] += 1
+            hot_path_logger.info(('udp', e.reason), 'Rejected datagram from %s: %s', addr[0], e)
+            return
+        if not self._take(self._agent_buckets, agent.uuid, self.agent_rate, AGENT_BURST, now):
+            self.stats['rate_limited'] += 1
+            return
+        asyncio.ensure_future(self._relay(agent, counter, frame))
+
+    def verify(self, data: bytes, now: float) -> Tuple[Agent, int, Frame]:
+        """Check everything about a datagram that needs no shared state, see ``claim_counter``."""
+        if len(data) < HEADER.size + TAG_SIZE + 2:
+            raise DatagramError('too short', 'datagram is too short')
+        version, agent_id, counter = HEADER.unpack_from(data)
+        if version != VERSION:
+            raise DatagramError('version', f'unknown version {version}')
+        agent, key = self._agent(agent_id.hex())
+        if agent is None:
+            raise DatagramError('unknown agent')
+        body, tag = data[:-TAG_SIZE], data[-TAG_SIZE:]
+        if not hmac.compare_digest(hmac.new(key, body, sha256).digest()[:TAG_SIZE], tag):
+            raise DatagramError('bad tag')
+        if abs(now * 1000 - counter) > REPLAY_WINDOW * 1000:
+            raise DatagramError('stale', 'counter is outside the replay window')
+        try:
+            frame = parse_frame(body[HEADER.size:], self.frame_max_size)
+        except FrameError as e:
+            raise DatagramError('frame', str(e))
+        return agent, counter, frame
+
+    async def claim_counter(self, agent_uuid: str, counter: int) -> bool:
+        """Advance the last counter of an agent on the broker, False when it was already used."""
+        key = COUNTER_KEY_PREFIX + agent_uuid
+        client = space_server.brokers.client_for(key)
+        return bool(await client.eval(CLAIM_COUNTER, 1, key, counter, ceil(2 * REPLAY_WINDOW)))
+
+    def _agent(self, agent_uuid: str):
+        cached = self._agents.get(agent_uuid)
+        if cached is None:
+            # unknown agents are cached too, so random uuids cost one query per ttl
+            agent = Agent.get_or_none(uuid=agent_uuid)
+            cached = (agent, udp_key(agent.token) if agent else None)
+            self._agents.set(agent_uuid, cached)
+        return cached
+
+    def forget_agent(self, agent_uuid: str):
+        """Drop a cached key, for when an agent token changes or the agent is deleted."""
+        self._agents.pop(agent_uuid)
+
+    @staticmethod
+    def _take(buckets: LRUCache, key, rate: float, burst: int, now: float) -> bool:
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(rate, burst, now)
+            buckets.set(key, bucket)
+        return bucket.take(now)
+
+    async def _relay(self, agent: Agent, counter: int, frame: Frame):
+        try:
+            if not await self.claim_counter(agent.uuid, counter):
+                self.stats['replayed'] += 1
+                hot_path_logger.info(('udp', 'replayed'), 'Rejected replayed datagram of agent %s', agent.name)
+                return
+            if await space_server.is_duplicate(frame, agent):
+                self.stats['duplicates'] += 1
+                return
+            try:
+                await space_server.relay(frame, agent)
+            except Exception:
+                await space_server.forget_frame(frame, agent)
+                raise
+            self.stats['relayed'] += 1
+        except Exception:
+            logger.exception('Unable to relay frame %s from agent %s', frame.name, agent.name)
+
+
+udp_ingest = UdpIngest()
@@ -1,4 +1,9 @@
 import datetime
+import logging
+import math
+from collections import OrderedDict
+from time import monotonic
+from time import time
 
 
 def timestamp():
@@ -15,7 +20,7 @@ def add_space_to_meta(frame, space_name, space_uuid):
     else:
         frame._meta = space_meta
 
-def clean_space_names(self, space_names):
+def clean_space_names(space_names):
     if not space_names:
         return set()
     if isinstance(space_names, str):
@@ -23,3 +28,118 @@ def clean_space_names(self, space_names):
     else:
         space_names = set(space_names)
     return space_names
+
+
+def parse_time(value):
+    """Return epoch seconds for epoch seconds or an ISO timestamp, None when it is neither.
+
+    ISO timestamps without an offset are taken to be UTC, like the ones made
+    by ``timestamp()``. NaN and infinity are neither.
+    """
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        pass
+    else:
+        return seconds if math.isfinite(seconds) else None
+    try:
+        parsed = datetime.datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.timestamp()
+
+
+def frame_deadline(frame):
+    """Return when a frame with ``meta.expires`` goes stale, in epoch seconds."""
+    expires = frame.meta.get('expires') if frame.meta else None
+    if expires is None:
+        return None
+    return parse_time(expires)
+
+
+def frame_expired(frame, now=None):
+    deadline = frame_deadline(frame)
+    return deadline is not None and deadline < (now or time())
+
+
+def target_agent_name(frame):
+    target = frame.meta.get('target') if frame.meta else None
+    if isinstance(target, dict):
+        return target.get('agent')
+    return None
+
+
+class LRUCache(object):
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            expires, value = self._data[key]
+        except KeyError:
+            return default
+        if expires is not None and expires < monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        expires = monotonic() + self.ttl if self.ttl else None
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, (None, default))[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RateLimitedLog(object):
+    """Log at most one record per key and interval, counting the rest.
+
+    Meant for messages logged once per frame. Arguments are formatted lazily
+    by the logging module and only for records that are actually emitted.
+    """
+
+    def __init__(self, logger, interval=10.0):
+        self._logger = logger
+        self._interval = interval
+        self._next_allowed = {}
+        self._suppressed = {}
+
+    def log(self, level, key, msg, *args):
+        if not self._logger.isEnabledFor(level):
+            return
+        now = monotonic()
+        if now < self._next_allowed.get(key, 0):
+            self._suppressed[key] = self._suppressed.get(key, 0) + 1
+            return
+        self._next_allowed[key] = now + self._interval
+        suppressed = self._suppressed.pop(key, 0)
+        if suppressed:
+            msg += ' (suppressed %d similar messages)'
+            args += (suppressed,)
+        self._logger.log(level, msg, *args)
+
+    def debug(self, key, msg, *args):
+        self.log(logging.DEBUG, key, msg, *args)
+
+    def info(self, key, msg, *args):
+        self.log(logging.INFO, key, msg, *args)
+
+    def warning(self, key, msg, *args):
+        self.log(logging.WARNING, key, msg, *args)
@@ -1,10 +1,14 @@
 import asyncio
 import logging
+import multiprocessing
+import os
+import signal
+import warnings
 from functools import wraps
 from hashlib import sha256
+from hmac import compare_digest
 from pathlib import Path
-from signal import SIGTERM
-from signal import SIGINT
+from threading import get_ident
 from uuid import uuid4
 
 from appdirs import AppDirs
@@ -16,28 +20,56 @@ from quart import abort as abort_request
 from quart import flash as flash_message
 from quart import g
 from quart import jsonify
+from quart import make_response
 from quart import request
 from quart import redirect
 from quart import render_template
 from quart import session
 from quart import url_for
 from quart import websocket
+from jinja2 import FileSystemBytecodeCache
+from werkzeug.exceptions import Unauthorized
 
-from zentropi import Frame
 from zentropi import Kind
 
 from . import __app_name__
 from . import __version__
 from . import configure_logging
+from .agent_server import KEEPALIVE_TIMEOUT
+from .agent_server import TAKEOVER_IDLE
 from .agent_server import AgentServer
+from .aggregate import aggregate_hub
+from .archive import frame_archive
+from .archive import take
+from .assets import static_assets
+from .broker import PUBLISH_BATCH_MAX
+from .broker import PUBLISH_WINDOW
+from .capture import traffic_capture
 from .config import BaseConfig
+from .diagnostics import collapse_stacks
+from .diagnostics import loop_monitor
+from .diagnostics import sample_stacks
+from .ingress import BUFFER_MAX_SIZE
+from .ingress import FRAME_MAX_SIZE
+from .ingress import FrameError
+from .ingress import parse_frame
 from .models import Account
 from .models import Agent
 from .models import Space
+from .models import bookkeeping
 from .models import db_init
+from .models import db_proxy
+from .name_filter import NameFilter
 from .space_server import space_server
+from .stream import stream_hub
+from .timers import timer_wheel
 from .token_auth import AgentTokenAuth
+from .udp import ADDRESS_RATE as UDP_ADDRESS_RATE
+from .udp import AGENT_RATE as UDP_AGENT_RATE
+from .udp import udp_ingest
 from .util import clean_space_names
+from .util import parse_time
+from .util import target_agent_name
 
 logger = logging.getLogger(__name__)
 
@@ -45,6 +77,7 @@ app_dirs = AppDirs('zencelium', version=__version__)
 
 CONFIG_PATH = Path(app_dirs.user_config_dir).joinpath(f'{__app_name__}.ini')
 LOG_PATH = Path(app_dirs.user_log_dir).joinpath(f'{__app_name__}.log')
+TEMPLATE_CACHE_PATH = Path(app_dirs.user_cache_dir).joinpath('templates')
 
 
 class Config(BaseConfig):
@@ -52,6 +85,37 @@ class Config(BaseConfig):
     log_file_path = str(LOG_PATH)
     log_level = 'warning'
     secret_key = ''
+    ingress_frame_max_size = str(FRAME_MAX_SIZE)
+    ingress_buffer_max_size = str(BUFFER_MAX_SIZE)
+    drain_timeout = '10'
+    agent_keepalive_timeout = str(KEEPALIVE_TIMEOUT)  # for agents that asked for ping commands at login
+    agent_takeover_idle = str(TAKEOVER_IDLE)  # seconds of silence before a new login replaces a connection
+    reconnect_delay_max = '30'
+    event_loop = 'asyncio'  # or uvloop, pip install zencelium[uvloop]
+    server_workers = '1'  # processes sharing the port through SO_REUSEPORT
+    server_backlog = '100'
+    server_keep_alive_timeout = '5'  # seconds an idle http connection is kept open
+    websocket_ping_interval = '20'  # seconds between websocket protocol pings, 0 for none
+    loop_lag_interval = '0.1'
+    loop_block_threshold = '0.5'
+    admin_token = ''
+    broker_urls = 'redis://localhost'
+    database_url = 'sqlite:///zencelium.db'
+    bookkeeping_flush_interval = '5'
+    dedup_window = '0'
+    dedup_shared = 'true'
+    publish_batch_window = str(PUBLISH_WINDOW)  # seconds, 0 (the default) publishes every frame on its own
+    publish_batch_size = str(PUBLISH_BATCH_MAX)
+    template_cache_path = str(TEMPLATE_CACHE_PATH)
+    capture_path = ''
+    capture_segment_size = str(64 * 1024 * 1024)
+    archive_path = ''
+    archive_segment_size = str(16 * 1024 * 1024)
+    archive_retention_age = str(7 * 24 * 3600)  # seconds, 0 keeps frames forever
+    archive_retention_size = '0'  # bytes per space, 0 for no limit
+    udp_port = '0'  # 0 turns the udp frame listener off
+    udp_agent_rate = str(UDP_AGENT_RATE)  # datagrams per second
+    udp_address_rate = str(UDP_ADDRESS_RATE)
 
     def init(self):
         if not self.secret_key:
@@ -60,17 +124,38 @@ class Config(BaseConfig):
 
 
 config = Config(app_name=f'{__app_name__}', config_path=CONFIG_PATH)
-config.init()
+_app_configured = False
 
 
-app = Quart(f'{__app_name__}')
+app = Quart(f'{__app_name__}', static_folder=None)  # served by static_file() below
 # app.jinja_env.extensions = ['jinja2.ext.i18n']
 app.jinja_env.line_statement_prefix = '@'
 app.jinja_env.line_comment_prefix = '##'
-app.secret_key = config.secret_key
 agent_auth = AgentTokenAuth(app)
 
 
+def configure_app(settings=None):
+    # reading (and maybe creating) the config file waits until the app is used
+    global _app_configured
+    if _app_configured:
+        return
+    config.init()
+    for name, value in (settings or {}).items():
+        if value is not None:
+            setattr(config, name, str(value))
+    app.secret_key = config.secret_key
+    app.config['MAX_CONTENT_LENGTH'] = int(config.ingress_frame_max_size)
+    AgentServer.ingress_max_size = int(config.ingress_frame_max_size)
+    AgentServer.ingress_buffer_size = int(config.ingress_buffer_max_size)
+    AgentServer.keepalive_timeout = float(config.agent_keepalive_timeout)
+    AgentServer.takeover_idle = float(config.agent_takeover_idle)
+    if config.template_cache_path:
+        # compiled templates survive restarts, so the first page view skips the parser
+        Path(config.template_cache_path).mkdir(parents=True, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(config.template_cache_path)
+    _app_configured = True
+
+
 def login_required(fn):
     @wraps(fn)
     async def inner(*args, **kwargs):
@@ -83,6 +168,40 @@ def login_required(fn):
     return inner
 
 
+def admin_required(fn):
+    @wraps(fn)
+    async def inner(*args, **kwargs):
+        token = request.headers.get('Authorization', '').replace('Bearer ', '')
+        if not config.admin_token or not compare_digest(token, config.admin_token):
+            raise Unauthorized()
+        return await fn(*args, **kwargs)
+
+    return inner
+
+
+@app.url_defaults
+def fingerprint_static_urls(endpoint, values):
+    if endpoint == 'static' and 'filename' in values:
+        values['filename'] = static_assets.url_filename(values['filename'])
+
+
+@app.route('/static/<path:filename>', endpoint='static')
+async def static_file(filename):
+    response = await static_assets.response(filename, request)
+    if response is None:
+        abort_request(404)
+    return response
+
+
+@app.after_request
+async def conditional_page(response):
+    # pages are still rendered, but an unchanged one is not sent again
+    if request.method == 'GET' and response.status_code == 200 and response.mimetype == 'text/html':
+        await response.add_etag()
+        response = await response.make_conditional(request)
+    return response
+
+
 @app.template_filter('plural')
 def plural(number, singular = '', plural = 's'):
     if number == 1:
@@ -91,16 +210,64 @@ def plural(number, singular = '', plural = 's'):
         return plural
 
 
+async def _flush_bookkeeping(interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            bookkeeping.flush()
+        except Exception as e:
+            logger.exception(e)
+
+
 @app.before_serving
 async def startup():
-    db_init('zencelium.db')
+    configure_app()
+    db_init(config.database_url)
     logger.info('Starting web server')
-    await space_server.init()
+    await space_server.init(
+        config.broker_urls.split(','),
+        dedup_window=float(config.dedup_window),
+        dedup_shared=config.dedup_shared.lower() in ('true', 'yes', '1'),
+        publish_window=float(config.publish_batch_window),
+        publish_batch_size=int(config.publish_batch_size))
+    await stream_hub.init(space_server.brokers)
+    await aggregate_hub.init(space_server.brokers)
+    if config.capture_path:
+        traffic_capture.start(config.capture_path, segment_size=int(config.capture_segment_size))
+    if config.archive_path:
+        frame_archive.start(
+            config.archive_path,
+            segment_size=int(config.archive_segment_size),
+            retention_age=float(config.archive_retention_age),
+            retention_size=int(config.archive_retention_size))
+    if udp_ingest.address:
+        udp_ingest.frame_max_size = int(config.ingress_frame_max_size)
+        udp_ingest.agent_rate = float(config.udp_agent_rate)
+        udp_ingest.address_rate = float(config.udp_address_rate)
+        await udp_ingest.start()
+    app.bookkeeping_task = asyncio.ensure_future(
+        _flush_bookkeeping(float(config.bookkeeping_flush_interval)))
+    if float(config.loop_block_threshold) > 0:
+        loop_monitor.interval = float(config.loop_lag_interval)
+        loop_monitor.threshold = float(config.loop_block_threshold)
+        loop_monitor.start()
 
 
 @app.after_serving
-def shutdown():
+async def shutdown():
     logger.info('Shutting down web server')
+    loop_monitor.stop()
+    udp_ingest.stop()
+    await space_server.flush()
+    await traffic_capture.stop()
+    await frame_archive.stop()
+    timer_wheel.stop()
+    bookkeeping_task = getattr(app, 'bookkeeping_task', None)
+    if bookkeeping_task is not None:  # startup may have failed before creating it
+        bookkeeping_task.cancel()
+    bookkeeping.flush()
+    if not db_proxy.is_closed():
+        db_proxy.close()
 
 
 @app.route('/')
@@ -222,6 +389,8 @@ async def agent_delete(account, name):
             print(f'Closing active connection for {agent.name}')
             await space_server.agent_close(agent)
         account.delete_agent(name)
+        space_server.forget_agent(agent)
+        udp_ingest.forget_agent(agent.uuid)
         await flash_message(f'Agent {name!r} deleted.', 'success')
         return redirect(url_for('agents'))
     except Exception as e:
@@ -390,32 +559,132 @@ async def space_leave(account, name):
 @app.route('/api/frame/', methods=['POST'])
 @agent_auth.login_required
 async def frame_create(agent):
-    frame_as_dict = await request.json
     try:
-        frame = Frame.from_dict(frame_as_dict)
-    except Exception as e:
-        logger.exception(e)
-        abort_request(400)
+        frame = parse_frame(await request.get_data(), int(config.ingress_frame_max_size))
+    except FrameError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
     try:
-        if frame.meta.get('spaces'):
-            space_names = clean_space_names(frame.meta.get('spaces'))
-            spaces = Space.select().where(Space.name.in_(space_names) & Space.account == agent.account)
-        else:
-            spaces = agent.spaces()
-        meta = {'source': {'name': agent.name}}
-        if frame.meta:
-            frame._meta.update(meta)
-        else:
-            frame._meta = meta
+        if await space_server.is_duplicate(frame, agent):
+            return jsonify({'status': 'ok', 'message': 'Duplicate frame was ignored.'})
         try:
-            await space_server.broadcast(frame, spaces)
-        except KeyError:
-            pass
+            sent = await space_server.relay(frame, agent)
+        except Exception:
+            await space_server.forget_frame(frame, agent)
+            raise
+        if not sent:
+            await space_server.forget_frame(frame, agent)
+            target = target_agent_name(frame)
+            return jsonify({'status': 'error', 'message': f'Agent {target!r} was not found.'}), 404
         return jsonify({'status': 'ok', 'message': 'Frame was sent.'})
     except Exception as e:
         logger.exception(e)
         return jsonify({'status': 'error', 'message': 'Unable to send frame.'})
 
+@app.route('/api/stream/')
+@agent_auth.login_required
+async def frame_stream(agent):
+    space_names = clean_space_names(request.args.get('spaces'))
+    channels = {space.uuid: space.name for space in agent.spaces()
+                if not space_names or space.name in space_names}
+    channels[agent.uuid] = agent.name
+    filters = {
+        kind: NameFilter(clean_space_names(request.args.get(arg, '*')))
+        for kind, arg in ((Kind.EVENT, 'event'), (Kind.MESSAGE, 'message'),
+                          (Kind.REQUEST, 'request'), (Kind.RESPONSE, 'request'))
+    }
+
+    def accept(kind, name):
+        try:
+            names = filters.get(Kind(kind))
+        except ValueError:
+            return False
+        return names is not None and name in names
+
+    last_event_id = request.headers.get('Last-Event-ID', request.args.get('last_event_id'))
+    subscription = await stream_hub.subscribe(
+        channels, accept,
+        last_event_id=int(last_event_id) if last_event_id and last_event_id.isdigit() else None)
+
+    async def events():
+        try:
+            yield b'retry: 3000\n\n'
+            while True:
+                entry = await subscription.get(timeout=15)
+                if entry is None:
+                    break
+                if not entry:
+                    yield b': keepalive\n\n'
+                    continue
+                yield f'id: {entry[0]}\ndata: {entry[3]}\n\n'.encode('utf-8')
+        finally:
+            await stream_hub.unsubscribe(subscription)
+
+    response = await make_response(events(), {
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+    response.timeout = None
+    return response
+
+
+ARCHIVE_LIMIT = 1000
+ARCHIVE_LIMIT_MAX = 10000
+ARCHIVE_READ_BATCH = 200
+
+
+@app.route('/api/archive/<space_name>/')
+@agent_auth.login_required
+async def archive_query(agent, space_name):
+    if not frame_archive.enabled:
+        return jsonify({'status': 'error', 'message': 'The frame archive is not enabled.'}), 404
+    space = next((space for space in agent.spaces() if space.name == space_name), None)
+    if space is None:
+        return jsonify({'status': 'error', 'message': f'Space {space_name!r} was not found.'}), 404
+    start = parse_time(request.args['start']) if 'start' in request.args else None
+    end = parse_time(request.args['end']) if 'end' in request.args else None
+    cursor = request.args.get('cursor')
+    limit = request.args.get('limit', ARCHIVE_LIMIT, type=int)
+    if ('start' in request.args and start is None) or ('end' in request.args and end is None):
+        return jsonify({'status': 'error', 'message': 'Expected start and end as epoch seconds or ISO time.'}), 400
+    if cursor is not None and not cursor.isdigit():
+        return jsonify({'status': 'error', 'message': 'Expected the cursor of an earlier response.'}), 400
+    names = NameFilter(clean_space_names(request.args['names'])) if request.args.get('names') else None
+    limit = min(max(limit, 1), ARCHIVE_LIMIT_MAX)
+    records = frame_archive.query(
+        space.uuid, after_seq=int(cursor) if cursor else None, start=start, end=end, names=names)
+
+    async def lines():
+        # segments are read in a worker thread, a batch at a time
+        loop = asyncio.get_event_loop()
+        sent = 0
+        last_seq = None
+        reading = None
+        try:
+            while sent < limit:
+                reading = loop.run_in_executor(None, take, records, min(ARCHIVE_READ_BATCH, limit - sent))
+                batch = await reading
+                if not batch:
+                    yield b'{"cursor": null}\n'
+                    return
+                for record in batch:
+                    yield f'{{"seq": {record.seq}, "time": {record.time}, "frame": {record.frame}}}\n'.encode('utf-8')
+                sent += len(batch)
+                last_seq = batch[-1].seq
+            yield f'{{"cursor": "{last_seq}"}}\n'.encode('utf-8')
+        finally:
+            # unmaps and closes the open segment when the client goes away early,
+            # once the worker thread is done with it
+            if reading is not None and not reading.done():
+                reading.add_done_callback(lambda _: records.close())
+            else:
+                records.close()
+
+    response = await make_response(lines(), {'Content-Type': 'application/x-ndjson'})
+    response.timeout = None
+    return response
+
+
 @app.route('/console/')
 @login_required
 async def console(account):
@@ -425,29 +694,162 @@ async def console(account):
         agent_spaces=agent.spaces())
 
 
+@app.route('/admin/loop/')
+@admin_required
+async def admin_loop():
+    return jsonify(loop_monitor.stats())
+
+
+@app.route('/admin/brokers/')
+@admin_required
+async def admin_brokers():
+    return jsonify(await space_server.brokers.health())
+
+
+@app.route('/admin/dedup/')
+@admin_required
+async def admin_dedup():
+    if space_server.deduplicator is None:
+        return jsonify({'enabled': False})
+    return jsonify(dict(space_server.deduplicator.stats(), enabled=True))
+
+
+@app.route('/admin/connections/')
+@admin_required
+async def admin_connections():
+    return jsonify(space_server.connections())
+
+
+@app.route('/admin/udp/')
+@admin_required
+async def admin_udp():
+    return jsonify(dict(udp_ingest.stats, enabled=udp_ingest.transport is not None))
+
+
+@app.route('/admin/profile/')
+@admin_required
+async def admin_profile():
+    seconds = request.args.get('seconds', 10, type=float)
+    loop = asyncio.get_event_loop()
+    # sample from a worker thread while the event loop keeps serving
+    stacks = await loop.run_in_executor(None, sample_stacks, get_ident(), seconds)
+    return collapse_stacks(stacks), 200, {'Content-Type': 'text/plain; charset=utf-8'}
+
+
 @app.websocket('/')
 async def agent_websocket():
+    if space_server.draining:
+        abort_request(503)
     agent_server = AgentServer(websocket)
     await agent_server.start()
 
 
-def run(bind, port, log_level=config.log_level):
-    global config
-    log_level = getattr(logging, log_level.upper())
-    configure_logging(log_level=log_level, file_path=config.log_file_path)
-
-    shutdown_event = asyncio.Event()
-
-    def _signal_handler(*_):
-        shutdown_event.set()
+def new_event_loop(name: str) -> asyncio.AbstractEventLoop:
+    if name == 'uvloop':
+        try:
+            import uvloop
+        except ImportError:
+            raise RuntimeError('uvloop is not installed, pip install zencelium[uvloop]')
+        return uvloop.new_event_loop()
+    if name != 'asyncio':
+        raise ValueError(f'Unknown event loop {name!r}, expected asyncio or uvloop.')
+    return asyncio.new_event_loop()
 
-    loop = asyncio.get_event_loop()
-    loop.add_signal_handler(SIGTERM, _signal_handler)
-    loop.add_signal_handler(SIGINT, _signal_handler)
 
+def server_config(bind, port) -> HypercornConfig:
     hyper_config = HypercornConfig()
-
     hyper_config.bind = [f'{bind}:{port}']
+    hyper_config.websocket_max_message_size = int(config.ingress_buffer_max_size)
+    hyper_config.keep_alive_timeout = float(config.server_keep_alive_timeout)
+    hyper_config.websocket_ping_interval = float(config.websocket_ping_interval) or None
+    hyper_config.backlog = int(config.server_backlog)
+    # more than one worker makes hypercorn bind with SO_REUSEPORT
+    hyper_config.workers = int(config.server_workers)
+    return hyper_config
+
+
+def run(bind, port, log_level=None, **settings):
+    """Serve until SIGTERM or SIGINT.
+
+    ``settings`` are config fields, such as ``server_workers`` or
+    ``event_loop``, that override the config file for this run.
+    """
+    configure_app(settings)
+    workers = int(config.server_workers)
+    if workers > 1:
+        new_event_loop(config.event_loop).close()  # fail here rather than in every worker
+        # migrate once, so the workers starting together find the schema up to date
+        db_init(config.database_url).close()
+        _run_workers(bind, port, log_level, settings, workers)
+    else:
+        _serve(bind, port, log_level)
+
+
+def _run_workers(bind, port, log_level, settings, workers):
+    context = multiprocessing.get_context('spawn')
+    processes = [
+        context.Process(target=_worker, args=(bind, port, log_level, settings), name=f'worker-{n}')
+        for n in range(workers)]
+    for process in processes:
+        process.start()
+
+    def _forward_signal(signum, _):
+        # workers drain on the first signal and stop on the second, like a single process
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signum)
+
+    signal.signal(signal.SIGTERM, _forward_signal)
+    signal.signal(signal.SIGINT, _forward_signal)
+    for process in processes:
+        process.join()
+    failed = [process.exitcode for process in processes if process.exitcode]
+    if failed:
+        raise SystemExit(failed[0])
+
+
+def _worker(bind, port, log_level, settings):
+    # leave the process group, so a ctrl-c on the terminal only reaches
+    # the parent, which passes it on once
+    os.setpgrp()
+    configure_app(settings)
+    _serve(bind, port, log_level)
+
+
+def _serve(bind, port, log_level):
+    log_level = getattr(logging, (log_level or config.log_level).upper())
+    configure_logging(log_level=log_level, file_path=config.log_file_path)
+
+    shutdown_event = asyncio.Event()
 
-    loop.run_until_complete(hypercorn_serve(
-        app, hyper_config, shutdown_trigger=shutdown_event.wait))
+    async def _drain_and_shutdown():
+        try:
+            await space_server.drain(
+                timeout=float(config.drain_timeout),
+                reconnect_delay=float(config.reconnect_delay_max))
+        finally:
+            shutdown_event.set()
+
+    def _signal_handler(*_):
+        if space_server.draining:
+            # a second signal skips the rest of the drain
+            shutdown_event.set()
+            return
+        logger.info('Draining connections before shutdown')
+        loop.create_task(_drain_and_shutdown())
+
+    loop = new_event_loop(config.event_loop)
+    asyncio.set_event_loop(loop)
+    loop.add_signal_handler(signal.SIGTERM, _signal_handler)
+    loop.add_signal_handler(signal.SIGINT, _signal_handler)
+
+    if int(config.udp_port):
+        # opened by startup, once the brokers the frames are relayed to are up
+        udp_ingest.address = (bind, int(config.udp_port))
+        udp_ingest.reuse_port = int(config.server_workers) > 1
+
+    with warnings.catch_warnings():
+        # workers only decides SO_REUSEPORT here, the processes are ours
+        warnings.filterwarnings('ignore', 'The config `workers` has no affect')
+        loop.run_until_complete(hypercorn_serve(
+            app, server_config(bind, port), shutdown_trigger=shutdown_event.wait))
@@ -0,0 +1,51 @@
+import asyncio
+from types import SimpleNamespace
+
+from zentropi import Frame
+from zentropi import Kind
+
+from zencelium.agent_server import AgentServer
+from zencelium.aggregate import AggregateHub
+
+
+class BrokenShardPubSub(object):
+    async def subscribe(self, channel):
+        if channel == 'broken':
+            raise ConnectionError('shard is down')
+
+    async def unsubscribe(self, channel):
+        pass
+
+    async def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        await asyncio.sleep(timeout)
+
+
+class RecordingAgentServer(AgentServer):
+    def __init__(self):
+        super().__init__(None)
+        self.sent = []
+
+    async def websocket_send(self, frame, frame_as_json=None):
+        self.sent.append((frame.name, frame.data))
+
+
+def test_aggregate_is_all_or_nothing(monkeypatch):
+    hub = AggregateHub()
+    hub.pubsub = BrokenShardPubSub()
+    monkeypatch.setattr('zencelium.agent_server.aggregate_hub', hub)
+
+    async def aggregate(spaces):
+        agent_server = RecordingAgentServer()
+        agent_server.spaces = spaces
+        await agent_server.cmd_aggregate(
+            Frame('aggregate', kind=Kind.COMMAND, data={'name': 'reading', 'field': 'celsius'}))
+        if hub._reader is not None:
+            hub._reader.cancel()
+        return agent_server.sent[-1]
+
+    kitchen, broken = SimpleNamespace(uuid='kitchen', name='kitchen'), SimpleNamespace(uuid='broken', name='broken')
+    name, _ = asyncio.run(aggregate((kitchen, broken)))
+    assert name == 'aggregate-failed'
+    assert hub.windows == {} and hub.channels == {}
+    name, data = asyncio.run(aggregate(()))
+    assert (name, data['reason']) == ('aggregate-failed', 'No spaces to aggregate.')
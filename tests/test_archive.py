@@ -0,0 +1,76 @@
+import asyncio
+import os
+
+from zencelium.archive import FrameArchive
+from zencelium.archive import SpaceArchive
+from zencelium.archive import take
+from zencelium.name_filter import NameFilter
+
+
+def frames(first, count):
+    return [(float(t), f'sensor.{t % 2}', f'{{"name": "sensor.{t % 2}", "data": {t}}}')
+            for t in range(first, first + count)]
+
+
+def test_write_and_query_over_segments(tmp_path):
+    archive = SpaceArchive(tmp_path, segment_size=2048)
+    archive.write(frames(0, 60))
+    archive.write(frames(60, 40))
+    assert len(archive.segments()) > 2
+
+    records = list(archive.read())
+    assert [record.seq for record in records] == list(range(1, 101))
+    assert records[10].time == 10.0 and records[10].frame == '{"name": "sensor.0", "data": 10}'
+
+    in_range = list(archive.read(start=20, end=29.5, names=NameFilter(['sensor.1'])))
+    assert [record.time for record in in_range] == [21, 23, 25, 27, 29]
+
+    first_page = take(archive.read(start=50), 10)
+    next_page = take(archive.read(after_seq=first_page[-1].seq, start=50), 10)
+    assert [record.time for record in first_page + next_page] == list(range(50, 70))
+
+
+def test_partial_record_is_dropped_before_appending(tmp_path):
+    archive = SpaceArchive(tmp_path)
+    archive.write(frames(0, 3))
+    _, path = archive.segments()[-1]
+    with path.open('ab') as segment:
+        segment.write(b'\x10\x00\x00')
+    SpaceArchive(tmp_path).write(frames(3, 2))
+    assert [record.seq for record in archive.read()] == [1, 2, 3, 4, 5]
+
+
+def test_retention_keeps_the_newest_segment(tmp_path):
+    archive = SpaceArchive(tmp_path, segment_size=512)
+    archive.write(frames(0, 50))
+    segments = archive.segments()
+    for _, path in segments[:-2]:
+        os.utime(path, (0, 0))
+    assert archive.enforce_retention(max_age=3600) == len(segments) - 2
+    assert archive.enforce_retention(max_size=1) == 1
+    assert archive.segments() == segments[-1:]
+    assert list(archive.read())[-1].seq == 50
+
+
+def test_end_skips_records_after_a_clock_step_back(tmp_path):
+    archive = SpaceArchive(tmp_path)
+    archive.write([(10.0, 'a', '{}'), (30.0, 'b', '{}'), (20.0, 'c', '{}')])
+    assert [record.name for record in archive.read(end=25)] == ['a', 'c']
+
+
+def test_stop_keeps_frames_in_order(tmp_path):
+    async def archive_frames():
+        frame_archive = FrameArchive()
+        frame_archive.start(tmp_path, flush_interval=0)
+        for i in range(200):
+            frame_archive.append('space', 'sensor', f'{{"data": {i}}}')
+            if i % 20 == 0:
+                await asyncio.sleep(0)  # let the flush loop start a write
+        await frame_archive.stop()
+        return frame_archive
+
+    frame_archive = asyncio.run(archive_frames())
+    records = list(frame_archive.query('space'))
+    assert [record.frame for record in records] == [f'{{"data": {i}}}' for i in range(200)]
+    assert [record.seq for record in records] == list(range(1, 201))
+    assert len(frame_archive._spaces) == 1
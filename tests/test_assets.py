@@ -0,0 +1,30 @@
+import gzip
+
+from zencelium.assets import StaticAssets
+from zencelium.assets import accepted_encoding
+
+
+def test_accepted_encoding():
+    assert accepted_encoding('') is None
+    assert accepted_encoding('gzip, deflate') == 'gzip'
+    assert accepted_encoding('gzip;q=0, deflate') is None
+    assert accepted_encoding('*') == 'gzip'
+
+
+def test_fingerprinted_urls(tmp_path):
+    tmp_path.joinpath('css').mkdir()
+    tmp_path.joinpath('css', 'app.css').write_text('body { color: black; }\n' * 50)
+    assets = StaticAssets(tmp_path)
+    url_filename = assets.url_filename('css/app.css')
+    assert url_filename.startswith('css/app.') and url_filename.endswith('.css')
+
+    asset, immutable = assets.lookup(url_filename)
+    assert immutable and asset.mimetype == 'text/css'
+    assert gzip.decompress(asset.variant('gzip')) == asset.data
+    assert assets.lookup('css/app.css') == (asset, False)
+    assert assets.lookup('css/app.000000000000.css') == (asset, False)
+    assert assets.lookup('../secret.txt') == (None, False)
+    assert assets.url_filename('missing.css') == 'missing.css'
+
+    tmp_path.joinpath('css', 'app.css').write_text('body { color: red; }\n' * 50)
+    assert assets.url_filename('css/app.css') != url_filename
@@ -0,0 +1,90 @@
+import asyncio
+from collections import Counter
+from types import SimpleNamespace
+
+from zencelium.broker import BatchPublisher
+from zencelium.broker import BrokerShards
+
+CHANNELS = [f'channel-{i}' for i in range(10000)]
+
+
+def test_channels_spread_over_shards():
+    shards = BrokerShards(['redis://a', 'redis://b', 'redis://c'])
+    counts = Counter(shards.shard_for(channel) for channel in CHANNELS)
+    assert sorted(counts) == [0, 1, 2]
+    assert min(counts.values()) > len(CHANNELS) / 3 * 0.8
+
+
+def test_adding_a_shard_moves_few_channels():
+    before = BrokerShards(['redis://a', 'redis://b', 'redis://c'])
+    after = BrokerShards(['redis://a', 'redis://b', 'redis://c', 'redis://d'])
+    moved = [
+        channel for channel in CHANNELS
+        if before.urls[before.shard_for(channel)] != after.urls[after.shard_for(channel)]
+    ]
+    assert all(after.urls[after.shard_for(channel)] == 'redis://d' for channel in moved)
+    assert len(moved) < len(CHANNELS) / 3
+
+
+class RecordingPipeline(object):
+    def __init__(self, sent):
+        self.sent = sent
+        self.commands = []
+
+    def publish(self, channel, data):
+        self.commands.append((channel, data))
+        return self
+
+    async def execute(self, raise_on_error=True):
+        await asyncio.sleep(0.001)
+        self.sent.append(self.commands)
+        return [1] * len(self.commands)
+
+
+def test_publishes_are_batched_in_order():
+    shards = BrokerShards(['redis://a'])
+    sent = []
+    shards.clients = [SimpleNamespace(pipeline=lambda transaction: RecordingPipeline(sent))]
+    publisher = BatchPublisher(shards, window=0.01, max_batch=4)
+
+    async def publish_all():
+        return await asyncio.gather(*(publisher.publish('channel', i) for i in range(10)))
+
+    assert asyncio.run(publish_all()) == [1] * 10
+    assert [len(batch) for batch in sent] == [4, 4, 2]
+    assert [data for batch in sent for _, data in batch] == list(range(10))
+    assert (publisher.batches, publisher.published) == (3, 10)
+
+
+def test_broadcast_shares_one_batch():
+    from zentropi import Frame
+
+    from zencelium.space_server import SpaceServer
+
+    shards = BrokerShards(['redis://a'])
+    sent = []
+    shards.clients = [SimpleNamespace(pipeline=lambda transaction: RecordingPipeline(sent))]
+    server = SpaceServer()
+    server.publisher = BatchPublisher(shards, window=0.01, max_batch=256)
+    spaces = [SimpleNamespace(uuid=f'space-{i}', name=f'space {i}') for i in range(3)]
+
+    asyncio.run(server.broadcast(Frame('reading'), spaces))
+    assert len(sent) == 1
+    assert [channel for channel, _ in sent[0]] == ['space-0', 'space-1', 'space-2']
+    assert all(f'"space {i}"' in data for i, (_, data) in enumerate(sent[0]))
+
+
+def test_health_reports_a_hanging_shard():
+    class Client(object):
+        def __init__(self, delay):
+            self.delay = delay
+
+        async def ping(self):
+            await asyncio.sleep(self.delay)
+            return True
+
+    shards = BrokerShards(['redis://a', 'redis://b'])
+    shards.clients = [Client(0), Client(60)]
+    report = asyncio.run(shards.health(timeout=0.05))
+    assert [(shard['url'], shard['ok']) for shard in report] == [('redis://a', True), ('redis://b', False)]
+    assert 'within' in report[1]['error']
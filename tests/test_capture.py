@@ -0,0 +1,50 @@
+import asyncio
+from types import SimpleNamespace
+
+from zencelium.capture import BROADCAST
+from zencelium.capture import INGRESS
+from zencelium.capture import TrafficCapture
+from zencelium.capture import read_capture
+
+
+def test_capture_round_trip_over_segments(tmp_path):
+    async def capture():
+        traffic_capture = TrafficCapture()
+        traffic_capture.start(tmp_path, segment_size=50)
+        for i in range(3):
+            traffic_capture.record(INGRESS, 'home', 'sensor', ['kitchen', 'hall'], f'{{"name": "temp-{i}"}}')
+            await traffic_capture.flush()
+        traffic_capture.record(BROADCAST, 'home', 'pösted', [], '{"name": "rest"}')
+        await traffic_capture.stop()
+
+    asyncio.run(capture())
+    assert len(list(tmp_path.glob('capture-*.zcap'))) == 4
+    records = list(read_capture(tmp_path))
+    assert [record.frame for record in records] == [
+        '{"name": "temp-0"}', '{"name": "temp-1"}', '{"name": "temp-2"}', '{"name": "rest"}']
+    assert records[0].spaces == ('kitchen', 'hall')
+    assert (records[-1].point, records[-1].agent, records[-1].spaces) == (BROADCAST, 'pösted', ())
+    assert records[0].time <= records[-1].time
+
+
+def test_capture_keeps_order_and_never_raises(tmp_path):
+    spaces = [f'space-{i:05d}' for i in range(10000)]  # longer than 64k once joined
+    broken = SimpleNamespace(name='broken', meta=None, to_json=lambda: 1 / 0)
+
+    async def capture():
+        traffic_capture = TrafficCapture()
+        traffic_capture.start(tmp_path)
+        flushes = []
+        for i in range(5):
+            traffic_capture.record(INGRESS, 'home', 'sensor', spaces, f'{{"name": "temp-{i}"}}')
+            flushes.append(traffic_capture.flush())
+        await asyncio.gather(*flushes)
+        traffic_capture.broadcast(broken, [SimpleNamespace(name='hall', account_id=None)])
+        await traffic_capture.stop()
+        return traffic_capture
+
+    traffic_capture = asyncio.run(capture())
+    assert (traffic_capture.records, traffic_capture.dropped) == (5, 1)
+    records = list(read_capture(tmp_path))
+    assert [record.frame for record in records] == [f'{{"name": "temp-{i}"}}' for i in range(5)]
+    assert records[0].spaces == tuple(spaces)
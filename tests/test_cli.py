@@ -0,0 +1,28 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+
+def test_cli_import_is_lazy():
+    code = (
+        'import sys, zencelium.cli; '
+        'print(sorted(m for m in ("quart", "hypercorn", "redis", "peewee", "bcrypt", "zencelium.web") '
+        'if m in sys.modules))'
+    )
+    output = subprocess.check_output([sys.executable, '-c', code], universal_newlines=True)
+    assert output == '[]\n'
+
+
+def test_database_defaults_to_config(tmp_path):
+    database = tmp_path / 'configured.db'
+    env = dict(os.environ, XDG_CONFIG_HOME=str(tmp_path / 'config'))
+    script = 'from zencelium.web import CONFIG_PATH; print(CONFIG_PATH)'
+    config_path = Path(subprocess.check_output([sys.executable, '-c', script], env=env, universal_newlines=True).strip())
+    config_path.parent.mkdir(parents=True)
+    config_path.write_text(f'[zencelium]\ndatabase_url = sqlite:///{database}\n')
+
+    subprocess.check_call(
+        [sys.executable, '-c', 'from zencelium.cli import cli; cli()', 'migrate'], env=env, cwd=str(tmp_path))
+    assert database.exists()
+    assert not (tmp_path / 'zencelium.db').exists()
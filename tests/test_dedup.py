@@ -0,0 +1,85 @@
+import asyncio
+
+from zencelium.dedup import FrameDeduplicator
+
+
+def test_duplicates_are_detected_within_window():
+    dedup = FrameDeduplicator(window=60)
+    seen = [asyncio.run(dedup.is_duplicate(agent, frame))
+            for agent, frame in (('a', '1'), ('a', '1'), ('b', '1'), ('a', '2'), ('a', ''))]
+    assert seen == [False, True, False, False, False]
+    stats = dedup.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (1, 3, 3)
+
+
+def test_entries_are_bounded():
+    dedup = FrameDeduplicator(window=60, max_entries=10)
+    for i in range(100):
+        asyncio.run(dedup.is_duplicate('a', str(i)))
+    assert dedup.stats()['entries'] <= 10
+
+
+def test_retry_after_failed_relay_is_not_a_duplicate():
+    dedup = FrameDeduplicator(window=60)
+
+    async def relay_then_retry():
+        assert not await dedup.is_duplicate('a', '1')
+        # relaying the frame failed, the client will retry it
+        await dedup.forget('a', '1')
+        retried = await dedup.is_duplicate('a', '1')
+        repeated = await dedup.is_duplicate('a', '1')
+        return retried, repeated
+
+    assert asyncio.run(relay_then_retry()) == (False, True)
+    assert dedup.stats()['entries'] == 1
+
+
+class SharedKeys(object):
+    """Stands in for the broker client, SET NX and DEL on a dict."""
+
+    def __init__(self):
+        self.keys = {}
+
+    def client_for(self, key):
+        return self
+
+    async def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.keys:
+            return None
+        self.keys[key] = value
+        return True
+
+    async def delete(self, key):
+        return int(self.keys.pop(key, None) is not None)
+
+
+def test_retry_on_another_worker_after_failed_relay_is_not_a_duplicate():
+    brokers = SharedKeys()
+    first, second = FrameDeduplicator(window=60, brokers=brokers), FrameDeduplicator(window=60, brokers=brokers)
+
+    async def relay_then_retry():
+        assert not await first.is_duplicate('a', '1')
+        await first.forget('a', '1')
+        return await second.is_duplicate('a', '1')
+
+    assert asyncio.run(relay_then_retry()) is False
+
+
+def test_broker_error_releases_the_key():
+    brokers = SharedKeys()
+    dedup = FrameDeduplicator(window=60, brokers=brokers)
+
+    async def broken_set(key, value, nx=False, ex=None):
+        raise ConnectionError('broker is down')
+
+    async def claim_twice():
+        brokers.set, working_set = broken_set, brokers.set
+        try:
+            await dedup.is_duplicate('a', '1')
+        except ConnectionError:
+            pass
+        brokers.set = working_set
+        return await dedup.is_duplicate('a', '1')
+
+    assert asyncio.run(claim_twice()) is False
+    assert dedup.stats()['entries'] == 1
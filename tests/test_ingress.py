@@ -0,0 +1,24 @@
+import json
+
+import pytest
+
+from zencelium.ingress import FrameError
+from zencelium.ingress import parse_frame
+from zencelium.ingress import parse_frames
+
+
+def frame_as_json(size=0):
+    return json.dumps({'kind': 2, 'name': 'reading', 'data': {'padding': 'x' * size}})
+
+
+def test_batch_is_parsed():
+    frames = parse_frames('[' + ','.join([frame_as_json()] * 3) + ']', max_size=1024)
+    assert [frame.name for frame in frames] == ['reading'] * 3
+
+
+def test_frame_too_large_for_max_size_is_rejected_alone_and_in_batch():
+    large = frame_as_json(2048)
+    with pytest.raises(FrameError):
+        parse_frame(large, max_size=1024)
+    with pytest.raises(FrameError, match='in batch'):
+        parse_frames('[' + large + ']', max_size=1024, buffer_max_size=8192)
@@ -0,0 +1,48 @@
+import pytest
+
+from zencelium.name_filter import NameFilter
+from zencelium.name_filter import shared_filter
+
+
+def test_exact_names():
+    names = NameFilter(['hello', 'sensor.kitchen.temp'])
+    assert 'hello' in names
+    assert 'sensor.kitchen.temp' in names
+    assert 'sensor.kitchen' not in names
+    assert 'world' not in names
+
+
+def test_match_all():
+    names = NameFilter(['*'])
+    assert 'hello' in names
+    assert 'sensor.kitchen.temp' in names
+
+
+def test_wildcards():
+    names = NameFilter(['sensor.kitchen.*', 'sensor.*.humidity'])
+    assert 'sensor.kitchen.temp' in names
+    assert 'sensor.kitchen.temp.celsius' in names
+    assert 'sensor.garage.humidity' in names
+    assert 'sensor.kitchen' not in names
+    assert 'sensor.garage.temp' not in names
+    assert 'sensor.garage.humidity.raw' not in names
+
+
+def test_add_invalidates_cache():
+    names = NameFilter()
+    assert 'hello' not in names
+    names.add('hello')
+    assert 'hello' in names
+    assert len(names) == 1
+
+
+def test_shared_filter_is_reused_and_frozen():
+    names = shared_filter(['sensor.*', 'hello'])
+    assert shared_filter(['hello', 'sensor.*']) is names
+    assert 'sensor.kitchen' in names
+    with pytest.raises(TypeError):
+        names.add('world')
+    wider = shared_filter(names.patterns | {'world'})
+    assert wider is not names
+    assert 'world' in wider
+    assert 'world' not in names
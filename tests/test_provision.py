@@ -0,0 +1,49 @@
+import io
+
+import pytest
+
+from zencelium.models import Account
+from zencelium.models import Agent
+from zencelium.models import db_init
+from zencelium.provision import export_records
+from zencelium.provision import import_records
+from zencelium.provision import read_records
+from zencelium.provision import write_records
+
+RECORDS = [
+    {'type': 'account', 'name': 'home', 'password': 'secret'},
+    {'type': 'space', 'account': 'home', 'name': 'kitchen'},
+    {'type': 'agent', 'account': 'home', 'name': 'thermostat', 'token': 'thermostat-token'},
+    {'type': 'membership', 'account': 'home', 'agent': 'thermostat', 'space': 'kitchen'},
+]
+
+
+def test_import_export_roundtrip(tmp_path):
+    db = db_init(str(tmp_path / 'zencelium.db'))
+    result = import_records(RECORDS)
+    assert result['created'] == {'account': 1, 'space': 2, 'agent': 2, 'membership': 1}
+    assert {'type': 'agent', 'account': 'home', 'name': 'thermostat', 'token': 'thermostat-token'} in result['tokens']
+
+    assert Account.login_account('home', 'secret').name == 'home'
+    agent = Agent.get(token='thermostat-token')
+    assert [space.name for space in agent.spaces()] == ['kitchen']
+
+    assert import_records(RECORDS)['skipped'] == len(RECORDS)
+
+    for fmt in ('jsonl', 'csv'):
+        stream = io.StringIO()
+        count = write_records(stream, export_records(), fmt)
+        stream.seek(0)
+        assert len(list(read_records(stream, fmt))) == count == 6
+    db.close()
+
+
+def test_unknown_reference_names_the_record(tmp_path):
+    db = db_init(str(tmp_path / 'zencelium.db'))
+    records = RECORDS + [{'type': 'membership', 'account': 'home', 'agent': 'thermostat', 'space': 'attic'}]
+    with pytest.raises(ValueError, match="Record 5: unknown space 'attic'"):
+        import_records(records)
+    with pytest.raises(ValueError, match="Record 1: unknown account 'away'"):
+        import_records([{'type': 'agent', 'account': 'away', 'name': 'thermostat'}])
+    assert Account.select().count() == 0
+    db.close()
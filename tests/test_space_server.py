@@ -0,0 +1,73 @@
+import asyncio
+from time import monotonic
+from types import SimpleNamespace
+
+import pytest
+
+from zencelium.agent_server import AgentServer
+from zencelium.space_server import SpaceServer
+
+AGENT = SimpleNamespace(uuid='a' * 32, name='sensor')
+
+
+class FakeSpace(object):
+    # spaces are interned in a WeakValueDictionary, which needs weak references
+    def __init__(self, uuid, name):
+        self.uuid = uuid
+        self.name = name
+
+
+def test_new_login_replaces_a_quiet_connection():
+    space_server = SpaceServer()
+    old, new = AgentServer(None), AgentServer(None)
+    old.last_activity = monotonic()
+
+    async def login(agent_server):
+        await space_server.agent_server_add(AGENT, agent_server)
+
+    asyncio.run(login(old))
+    with pytest.raises(ConnectionError, match='already connected'):
+        asyncio.run(login(new))
+    old.last_activity -= AgentServer.takeover_idle  # half-open, nothing heard for a while
+    asyncio.run(login(new))
+    assert space_server.agent_servers[AGENT.uuid] is new
+
+
+def test_spaces_update_stores_interned_spaces():
+    space_server = SpaceServer()
+    agent_server = AgentServer(None)
+    space_server.agent_servers[AGENT.uuid] = agent_server
+    shared = space_server.intern_space(FakeSpace('k' * 32, 'kitchen'))
+
+    asyncio.run(space_server.agent_spaces_update(AGENT, [FakeSpace('k' * 32, 'kitchen')]))
+    assert isinstance(agent_server.spaces, frozenset)
+    assert list(agent_server.spaces) == [shared]
+    assert next(iter(agent_server.spaces)) is shared
+
+
+def test_connections_count_subscribers_per_space_uuid():
+    space_server = SpaceServer()
+    kitchen = FakeSpace('k' * 32, 'kitchen')
+    other_kitchen = FakeSpace('o' * 32, 'kitchen')  # same name in another account
+    hall = FakeSpace('h' * 32, 'hall')
+    for name, spaces, frames_in in (('sensor', {kitchen, hall}, 3), ('lamp', {kitchen, other_kitchen}, 5)):
+        agent_server = AgentServer(None)
+        agent_server.agent = SimpleNamespace(uuid=name * 4, name=name)
+        agent_server.account = SimpleNamespace(name='home')
+        agent_server.spaces = frozenset(spaces)
+        agent_server.frames_in = frames_in
+        agent_server.bytes_in = frames_in * 100
+        agent_server.last_activity = monotonic()
+        space_server.agent_servers[agent_server.agent.uuid] = agent_server
+
+    connections = space_server.connections()
+    assert connections['spaces'] == {
+        kitchen.uuid: {'name': 'kitchen', 'subscribers': 2},
+        other_kitchen.uuid: {'name': 'kitchen', 'subscribers': 1},
+        hall.uuid: {'name': 'hall', 'subscribers': 1},
+    }
+    described = {connection['agent']: connection for connection in connections['connections']}
+    assert described['sensor']['spaces'] == ['hall', 'kitchen']
+    assert (described['lamp']['frames_in'], described['lamp']['bytes_in']) == (5, 500)
+    assert (described['sensor']['account'], described['sensor']['queue_depth']) == ('home', 0)
+    assert described['sensor']['idle_for'] < 1
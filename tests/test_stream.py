@@ -0,0 +1,60 @@
+import asyncio
+
+from zencelium import stream
+from zencelium.stream import StreamHub
+
+
+class FlakyPubSub(object):
+    def __init__(self, messages):
+        self.messages = list(messages)
+        self.subscribed = []
+        self.failed = False
+
+    async def subscribe(self, *channels):
+        self.subscribed.extend(channels)
+
+    async def unsubscribe(self, *channels):
+        for channel in channels:
+            self.subscribed.remove(channel)
+
+    async def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        if not self.failed:
+            self.failed = True
+            raise ConnectionError('broker went away')
+        if self.messages:
+            return self.messages.pop(0)
+        await asyncio.sleep(0.01)
+        return None
+
+
+def test_reader_survives_broker_errors(monkeypatch):
+    monkeypatch.setattr(stream, 'READ_RETRY_DELAY', 0.01)
+    hub = StreamHub()
+    hub.pubsub = FlakyPubSub([{'channel': b'space', 'data': b'{"kind": 2, "name": "reading"}'}])
+
+    async def read_one():
+        subscription = await hub.subscribe({'space': 'kitchen'}, lambda kind, name: True)
+        entry = await subscription.get(timeout=1.0)
+        hub._reader.cancel()
+        return entry
+
+    entry = asyncio.run(read_one())
+    assert entry[2] == 'reading'
+
+
+def test_subscribe_while_expiring_keeps_the_channel():
+    hub = StreamHub()
+    hub.pubsub = FlakyPubSub([])
+
+    async def expire_then_subscribe():
+        subscription = await hub.subscribe({'space': 'kitchen'}, lambda kind, name: True)
+        await hub.unsubscribe(subscription)
+        hub._lingering.pop('space').cancel()
+        hub._expire('space')
+        await hub.subscribe({'space': 'kitchen'}, lambda kind, name: True)
+        await asyncio.sleep(0.01)  # let the expiry's unsubscribe run
+        hub._reader.cancel()
+
+    asyncio.run(expire_then_subscribe())
+    # subscribed twice and never unsubscribed, the expiry saw the new subscriber
+    assert hub.pubsub.subscribed == ['space', 'space']
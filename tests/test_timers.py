@@ -0,0 +1,21 @@
+import asyncio
+
+from zencelium.timers import TimerWheel
+
+
+def test_timers_fire_in_order_and_can_be_cancelled():
+    fired = []
+
+    async def run():
+        wheel = TimerWheel(resolution=0.01, slots=4)
+        wheel.schedule(0.05, fired.append, 'late')  # more than one lap around the wheel
+        wheel.schedule(0.01, fired.append, 'early')
+        wheel.schedule(0.02, fired.append, 'cancelled').cancel()
+        await asyncio.sleep(0.03)
+        assert fired == ['early']
+        await asyncio.sleep(0.06)
+        wheel.stop()
+        return wheel.scheduled
+
+    assert asyncio.run(run()) == 0
+    assert fired == ['early', 'late']
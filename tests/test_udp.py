@@ -0,0 +1,79 @@
+import asyncio
+import json
+from time import time
+from types import SimpleNamespace
+
+import pytest
+
+from zencelium.space_server import space_server
+from zencelium.udp import DatagramError
+from zencelium.udp import TokenBucket
+from zencelium.udp import UdpIngest
+from zencelium.udp import pack_datagram
+from zencelium.udp import udp_key
+
+AGENT_UUID = '0123456789abcdef0123456789abcdef'
+TOKEN = 'secret-token'
+FRAME = json.dumps({'kind': 2, 'name': 'reading', 'uuid': 'f' * 32, 'data': {'celsius': 21.5}})
+
+
+@pytest.fixture
+def ingest():
+    ingest = UdpIngest()
+    agent = SimpleNamespace(uuid=AGENT_UUID, name='sensor', token=TOKEN)
+    ingest._agents.set(AGENT_UUID, (agent, udp_key(TOKEN)))
+    return ingest
+
+
+def test_signed_datagram_is_accepted(ingest):
+    now = time()
+    agent, counter, frame = ingest.verify(pack_datagram(AGENT_UUID, TOKEN, FRAME, int(now * 1000)), now)
+    assert agent.name == 'sensor'
+    assert counter == int(now * 1000)
+    assert frame.name == 'reading'
+
+
+class CounterBroker(object):
+    """Stands in for the broker client running CLAIM_COUNTER."""
+
+    def __init__(self):
+        self.counters = {}
+
+    def client_for(self, key):
+        return self
+
+    async def eval(self, script, numkeys, key, counter, expire):
+        if self.counters.get(key, -1) >= counter:
+            return 0
+        self.counters[key] = counter
+        return 1
+
+
+def test_replayed_and_stale_datagrams_are_rejected(ingest, monkeypatch):
+    monkeypatch.setattr(space_server, 'brokers', CounterBroker(), raising=False)
+    now = time()
+    datagram = pack_datagram(AGENT_UUID, TOKEN, FRAME, int(now * 1000))
+    _, counter, _ = ingest.verify(datagram, now)
+    assert asyncio.run(ingest.claim_counter(AGENT_UUID, counter))
+    # another worker verifies the same datagram, the broker refuses the counter
+    _, counter, _ = ingest.verify(datagram, now)
+    assert not asyncio.run(ingest.claim_counter(AGENT_UUID, counter))
+    with pytest.raises(DatagramError, match='replay window'):
+        ingest.verify(pack_datagram(AGENT_UUID, TOKEN, FRAME, int((now - 60) * 1000)), now)
+
+
+def test_wrong_key_and_tampering_are_rejected(ingest):
+    now = time()
+    with pytest.raises(DatagramError, match='bad tag'):
+        ingest.verify(pack_datagram(AGENT_UUID, 'other-token', FRAME, int(now * 1000)), now)
+    datagram = bytearray(pack_datagram(AGENT_UUID, TOKEN, FRAME, int(now * 1000)))
+    datagram[30] ^= 1
+    with pytest.raises(DatagramError, match='bad tag'):
+        ingest.verify(bytes(datagram), now)
+
+
+def test_token_bucket_refills():
+    bucket = TokenBucket(rate=1.0, burst=2, now=0.0)
+    assert [bucket.take(0.0) for _ in range(3)] == [True, True, False]
+    assert bucket.take(1.0)
+    assert not bucket.take(1.0)
@@ -0,0 +1,62 @@
+import logging
+from types import SimpleNamespace
+
+from zencelium.util import LRUCache
+from zencelium.util import RateLimitedLog
+from zencelium.util import frame_deadline
+from zencelium.util import frame_expired
+from zencelium.util import parse_time
+
+
+def test_rate_limited_log_counts_suppressed(caplog):
+    caplog.set_level(logging.INFO)
+    log = RateLimitedLog(logging.getLogger('test_util'), interval=0)
+    log.info('key', 'first %s', 1)
+    assert caplog.messages == ['first 1']
+
+    log = RateLimitedLog(logging.getLogger('test_util'), interval=3600)
+    caplog.clear()
+    for i in range(5):
+        log.info('key', 'frame %d', i)
+    log.info('other', 'other')
+    assert caplog.messages == ['frame 0', 'other']
+
+    log._next_allowed['key'] = 0
+    log.info('key', 'frame %d', 5)
+    assert caplog.messages[-1] == 'frame 5 (suppressed 4 similar messages)'
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert 'b' not in cache
+    assert cache.get('a') == 1
+    assert cache.pop('c') == 3
+    assert len(cache) == 1
+
+
+def test_lru_cache_expires_entries():
+    cache = LRUCache(ttl=-1)
+    cache.set('a', 1)
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_frame_deadline_reads_epoch_and_iso_expiry():
+    assert frame_deadline(SimpleNamespace(meta={})) is None
+    assert frame_deadline(SimpleNamespace(meta={'expires': 100})) == 100.0
+    assert frame_deadline(SimpleNamespace(meta={'expires': '1970-01-01T00:01:40'})) == 100.0
+    assert frame_deadline(SimpleNamespace(meta={'expires': 'soon'})) is None
+    assert frame_expired(SimpleNamespace(meta={'expires': 100}), now=101)
+    assert not frame_expired(SimpleNamespace(meta={'expires': 100}), now=99)
+
+
+def test_parse_time_refuses_nan_and_infinity():
+    assert parse_time('1.5') == 1.5
+    assert parse_time('1970-01-01T00:00:02+00:00') == 2.0
+    assert parse_time('nan') is None
+    assert parse_time('-inf') is None
+    assert parse_time(float('inf')) is None